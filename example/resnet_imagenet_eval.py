@@ -54,9 +54,13 @@ def get_iter(split, batch_size=128, cycle=False, max_queue_size=20,
         batch_size=batch_size, cycle=cycle,
         get_fn=data[split].get_batch_idx)
     if opt['prefetch']:
+        # The tuner sizes the pool between 1 and num_threads producers, and
+        # the queue between 2 and 2 * max_queue_size batches. By default it
+        # could grow the pool to 2 * num_threads.
         return ConcurrentBatchIterator(
             batch_iter, max_queue_size=max_queue_size,
-            num_threads=num_threads)
+            num_threads=num_threads, auto_tune=True,
+            num_threads_range=(1, num_threads))
     else:
         return batch_iter
 
@@ -124,6 +128,7 @@ def run_once():
                     .set_iter(get_iter('valid', batch_size=opt['batch_size']))
                     .set_phase_train(False)
                     .set_num_batch(500000)   # Just something more than needed.
+                    .set_streaming(True)
                     .set_interval(1))
             ).run()
 
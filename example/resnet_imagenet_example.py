@@ -84,6 +84,7 @@ def get_data(split, batch_size=128, cycle=True, max_queue_size=10,
     .set_logs_folder(os.path.join(opt['logs'], uid))
     .set_localhost(opt['localhost'])
     .restore_logs(opt['restore_logs'])
+    .restore_iters_from(opt['restore_model'])
 
     .add_csv_output('Loss', ['train'])
     .add_csv_output('Top 1 Accuracy', ['train', 'valid'])
@@ -5,4 +5,5 @@ from sample_data_provider import SampleDataProvider
 from label_sample_data_provider import LabelSampleDataProvider      
 from list_image_data_provider import ListImageDataProvider
 from img_preproc import ImagePreprocessor
+from sample_cache import SampleCache
 import synset
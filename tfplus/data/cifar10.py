@@ -11,11 +11,20 @@ tfplus.cmd_args.add('cifar10:dataset_folder', 'str',
 
 class CIFAR10DataProvider(tfplus.data.data_provider.DataProvider):
     """
-        x: First divide by 255, then substract pixel mean.
+        x: Substract pixel mean, per batch. The images are kept as uint8.
     """
 
 
-    def __init__(self, split='train', filename=None):
+    def __init__(self, split='train', filename=None, sparse_labels=False,
+                 memmap=False):
+        """
+        Args:
+            sparse_labels: bool, whether to output y_gt as [N] int32 labels
+            instead of [N, 10] one-hot.
+            memmap: bool, whether to convert the split to .npy files in the
+            dataset folder once, and memory-map them, so that concurrent jobs
+            share one copy.
+        """
         super(CIFAR10DataProvider, self).__init__()
         self.log = tfplus.utils.logger.get()
         if split is None:
@@ -26,56 +35,77 @@ class CIFAR10DataProvider(tfplus.data.data_provider.DataProvider):
         self.filename = filename
         self._images = None
         self._labels = None
+        self._pixel_mean = None
+        self._sparse_labels = sparse_labels
+        self._memmap = memmap
         self.register_option('cifar10:dataset_folder')
         pass
 
-    def init_data(self):
-        if self.split == 'train':
-            self._images = np.zeros([50000, 32, 32, 3], dtype='uint8')
-            self._labels = np.zeros([50000], dtype='int')
-            for batch in xrange(5):
-                fname = os.path.join(self.get_option(
-                    'cifar10:dataset_folder'), 'data_batch_{}'.format(
-                    batch + 1))
-                start = batch * 10000
-                end = (batch + 1) * 10000
-                with open(fname, 'rb') as fo:
-                    _data = pkl.load(fo)
-                    self._images[start: end] = _data['data'].reshape(
-                        [10000, 3, 32, 32]).transpose([0, 2, 3, 1])
-                    self._labels[start: end] = np.array(_data['labels'])
-        elif self.split == 'test':
-            fname = os.path.join(self.get_option(
-                'cifar10:dataset_folder'), 'test_batch')
-            with open(fname, 'rb') as fo:
+    @property
+    def folder(self):
+        return self.get_option('cifar10:dataset_folder')
+
+    def read_batches(self, names):
+        """Read pickled CIFAR-10 batches.
+
+        Returns:
+            images: [N, 32, 32, 3] uint8.
+            labels: [N] int.
+        """
+        images = np.zeros([10000 * len(names), 32, 32, 3], dtype='uint8')
+        labels = np.zeros([10000 * len(names)], dtype='int')
+        for kk, name in enumerate(names):
+            start = kk * 10000
+            end = (kk + 1) * 10000
+            with open(os.path.join(self.folder, name), 'rb') as fo:
                 _data = pkl.load(fo)
-                self._images = _data['data'].reshape(
+                images[start: end] = _data['data'].reshape(
                     [10000, 3, 32, 32]).transpose([0, 2, 3, 1])
-                self._labels = np.array(_data['labels'])
-            pass
+                labels[start: end] = np.array(_data['labels'])
+        return images, labels
+
+    def get_batch_names(self, split):
+        if split == 'train':
+            return ['data_batch_{}'.format(batch + 1) for batch in xrange(5)]
+        elif split == 'test':
+            return ['test_batch']
+        else:
+            raise Exception('Unknown split: {}'.format(split))
+
+    def init_pixel_mean(self, train_images=None):
+        """Load the training pixel mean from its sidecar file, or compute and
+        save it."""
+        fname = os.path.join(self.folder, 'pixel_mean.npy')
+        if os.path.exists(fname):
+            self._pixel_mean = np.load(fname)
+            return
+        if train_images is None:
+            train_images, _ = self.read_batches(self.get_batch_names('train'))
+        self._pixel_mean = train_images.mean(
+            axis=0, dtype='float64').astype('float32')
+        tfplus.data.data_provider.save_npy(fname, self._pixel_mean)
+        pass
+
+    def init_data(self):
+        names = self.get_batch_names(self.split)
+        image_fname = os.path.join(self.folder, self.split + '_images.npy')
+        label_fname = os.path.join(self.folder, self.split + '_labels.npy')
+        if self._memmap and os.path.exists(image_fname) and \
+                os.path.exists(label_fname):
+            images = np.load(image_fname, mmap_mode='r')
+            labels = np.load(label_fname)
         else:
-            raise Exception('Unknown split: {}'.format(self.split))
-        # self._images = (self._images / 255).astype('float32')
-        self._images = self._images.astype('float32')
+            images, labels = self.read_batches(names)
+            dp = tfplus.data.data_provider
+            if self._memmap and dp.save_npy(image_fname, images) and \
+                    dp.save_npy(label_fname, labels):
+                images = np.load(image_fname, mmap_mode='r')
         if self.split == 'train':
-            self._pixel_mean = self._images.mean(axis=0)
+            self.init_pixel_mean(train_images=images)
         else:
-            _images = np.zeros([50000, 32, 32, 3], dtype='uint8')
-            for batch in xrange(5):
-                fname = os.path.join(self.get_option(
-                    'cifar10:dataset_folder'), 'data_batch_{}'.format(
-                    batch + 1))
-                start = batch * 10000
-                end = (batch + 1) * 10000
-                with open(fname, 'rb') as fo:
-                    _data = pkl.load(fo)
-                    _images[start: end] = _data['data'].reshape(
-                        [10000, 3, 32, 32]).transpose([0, 2, 3, 1])
-            # self._pixel_mean = (_images / 255).astype('float32').mean(axis=0)
-            self._pixel_mean = _images.astype('float32').mean(axis=0)
-            _images = None
-        self._images = self._images - self._pixel_mean
-        # self._images = self._images / 255
+            self.init_pixel_mean()
+        self._labels = labels
+        self._images = images
         pass
 
     def get_size(self):
@@ -86,15 +116,17 @@ class CIFAR10DataProvider(tfplus.data.data_provider.DataProvider):
         else:
             raise Exception('Unknown split {}'.format(self.split))
 
-    def get_batch_idx(self, idx, **kwargs):
+    def get_batch_idx(self, idx, out=None, **kwargs):
         if self._images is None:
             self.init_data()
-        labels = self._labels[idx]
-        y_gt = np.zeros([len(idx), 10], dtype='float32')
-        y_gt[np.arange(len(idx)), labels] = 1.0
+        dp = tfplus.data.data_provider
+        x = dp.get_output(out, 'x', [len(idx), 32, 32, 3])
+        np.subtract(self._images[idx], self._pixel_mean, out=x,
+                    casting='unsafe')
         results = {
-            'x': self._images[idx],
-            'y_gt': y_gt
+            'x': x,
+            'y_gt': dp.get_labels(self._labels[idx], 10,
+                                  sparse=self._sparse_labels, out=out)
         }
         return results
 
@@ -0,0 +1,86 @@
+"""
+Vectorized colour jitter, over a batch of images at once.
+
+Follows the TensorFlow image ops used in ImagePreprocessor.build_colour_graph:
+random brightness, saturation, hue, and contrast, in that order, followed by
+clipping to [0, 1]. Every image of the batch gets its own random factors.
+
+The HSV round trip runs in OpenCV on the whole batch, seen as one tall image,
+and writes back into the batch.
+
+See colour_test.py for the equivalence with the TensorFlow ops, and
+colour_benchmark.py for the throughput.
+
+Usage:
+    # images: [N, H, W, 3] float32 in [0, 1], C-contiguous, modified in place.
+    colour.random_colour(images, np.random.RandomState(2), bgr=True)
+"""
+from __future__ import division
+
+import cv2
+import numpy as np
+
+
+def adjust_colour(images, brightness, saturation, hue, contrast, bgr=False):
+    """Apply colour adjustments in place.
+
+    Args:
+        images: [N, H, W, 3] float32, C-contiguous.
+        brightness: [N], delta added to all channels.
+        saturation: [N], factor on the saturation.
+        hue: [N], delta on the hue, in turns.
+        contrast: [N], factor on the distance to the per-channel mean.
+        bgr: bool, channel order of the images, RGB by default.
+
+    Returns:
+        images
+    """
+    if not images.flags['C_CONTIGUOUS']:
+        raise Exception('Colour jitter needs a C-contiguous batch')
+    if bgr:
+        to_hsv, from_hsv = cv2.COLOR_BGR2HSV, cv2.COLOR_HSV2BGR
+    else:
+        to_hsv, from_hsv = cv2.COLOR_RGB2HSV, cv2.COLOR_HSV2RGB
+    images += brightness.astype('float32')[:, None, None, None]
+
+    # View the batch as one [N * H, W, 3] image.
+    flat = images.reshape([-1, images.shape[2], 3])
+    cv2.cvtColor(flat, to_hsv, dst=flat)
+    # Hue in degrees, saturation in [0, 1]. OpenCV wraps hues in [0, 720),
+    # so shift by a positive delta instead of taking the modulo.
+    h = images[..., 0]
+    h += (np.mod(hue, 1.0) * 360).astype('float32')[:, None, None]
+    s = images[..., 1]
+    s *= saturation.astype('float32')[:, None, None]
+    np.minimum(s, 1.0, out=s)
+    np.maximum(s, 0.0, out=s)
+    cv2.cvtColor(flat, from_hsv, dst=flat)
+
+    mean = np.array([cv2.mean(image)[:3] for image in images],
+                    dtype='float32')[:, None, None, :]
+    images -= mean
+    images *= contrast.astype('float32')[:, None, None, None]
+    images += mean
+    np.clip(images, 0.0, 1.0, out=images)
+    return images
+
+
+def random_colour(images, random, max_brightness=32. / 255.,
+                  saturation=(0.5, 1.5), max_hue=0.1, contrast=(0.5, 1.5),
+                  bgr=False):
+    """Draw colour factors for every image of a batch and apply them in place.
+
+    Args:
+        images: [N, H, W, 3] float32 in [0, 1], C-contiguous.
+        random: numpy RandomState.
+        bgr: bool, channel order of the images.
+    """
+    num = images.shape[0]
+    return adjust_colour(
+        images,
+        brightness=random.uniform(-max_brightness, max_brightness, num),
+        saturation=random.uniform(saturation[0], saturation[1], num),
+        hue=random.uniform(-max_hue, max_hue, num),
+        contrast=random.uniform(contrast[0], contrast[1], num),
+        bgr=bgr)
+
@@ -0,0 +1,39 @@
+"""
+Throughput of the colour jitter backends of ImagePreprocessor, on a
+training-size batch.
+
+Usage:
+    python colour_benchmark.py
+"""
+from __future__ import division
+
+import numpy as np
+import time
+
+import colour
+from img_preproc import ImagePreprocessor
+
+
+def benchmark(batch_size=64, size=224, num_iter=10):
+    """
+    Returns:
+        results: dict, backend => images per second.
+    """
+    random = np.random.RandomState(0)
+    batch = random.uniform(
+        0.0, 1.0, [batch_size, size, size, 3]).astype('float32')
+    proc = ImagePreprocessor(colour_backend='tf')
+    start = time.time()
+    for img in batch:
+        proc.sess.run(proc.image_out, feed_dict={proc.image_in: img})
+    results = {'tf': batch_size / (time.time() - start)}
+    start = time.time()
+    for ii in xrange(num_iter):
+        colour.random_colour(batch, random)
+    results['numpy'] = batch_size * num_iter / (time.time() - start)
+    return results
+
+
+if __name__ == '__main__':
+    for backend, rate in sorted(benchmark().iteritems()):
+        print '{:6s} {:.1f} images/s'.format(backend + ':', rate)
@@ -0,0 +1,71 @@
+from __future__ import division
+
+import cv2
+import numpy as np
+import unittest
+
+from tfplus.data import colour
+from tfplus.data.img_preproc import ImagePreprocessor
+
+
+def ks_stat(a, b):
+    """Two-sample Kolmogorov-Smirnov statistic."""
+    grid = np.sort(np.concatenate([a, b]))
+    cdf_a = np.searchsorted(np.sort(a), grid, side='right') / a.size
+    cdf_b = np.searchsorted(np.sort(b), grid, side='right') / b.size
+    return np.abs(cdf_a - cdf_b).max()
+
+
+def get_images(random, num_images=8, size=64):
+    """Smooth images with some saturation, so that all four jitters
+    matter."""
+    base = random.uniform(0.0, 1.0, [num_images, 8, 8, 3]).astype('float32')
+    return np.array([cv2.resize(img, (size, size)) for img in base])
+
+
+class ColourTest(unittest.TestCase):
+
+    def test_identity(self):
+        images = get_images(np.random.RandomState(0))
+        num = images.shape[0]
+        out = colour.adjust_colour(
+            images.copy(), brightness=np.zeros(num),
+            saturation=np.ones(num), hue=np.zeros(num),
+            contrast=np.ones(num))
+        np.testing.assert_allclose(out, images, atol=1e-4)
+        pass
+
+    def test_equivalence(self):
+        """Statistical equivalence with the TensorFlow colour graph.
+
+        The random factors are drawn by different generators, so the two
+        implementations are compared on the distributions of per-image
+        statistics over many jittered copies of the same images.
+        """
+        random = np.random.RandomState(0)
+        base = get_images(random)
+        proc = ImagePreprocessor(colour_backend='tf')
+        stats = {'tf': [], 'numpy': []}
+        for dd in xrange(200):
+            for img in base:
+                out_tf = proc.sess.run(proc.image_out, feed_dict={
+                    proc.image_in: img})
+                out_np = colour.random_colour(img.copy()[None], random)[0]
+                for key, out in [('tf', out_tf), ('numpy', out_np)]:
+                    stats[key].append(np.concatenate([
+                        out.mean(axis=(0, 1)), out.std(axis=(0, 1))]))
+        a_all = np.array(stats['tf'])
+        b_all = np.array(stats['numpy'])
+        names = ['mean_r', 'mean_g', 'mean_b', 'std_r', 'std_g', 'std_b']
+        for kk, name in enumerate(names):
+            a = a_all[:, kk]
+            b = b_all[:, kk]
+            # 99.9% critical value for equal sample sizes.
+            crit = 1.95 * np.sqrt(2 / a.size)
+            self.assertLess(ks_stat(a, b), crit, name)
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
+import numpy as np
 import os
 
 from tfplus.utils import cmd_args, OptionBase, Factory, BatchIterator
+from tfplus.utils import logger
 
 _factory = None
 
@@ -25,8 +27,90 @@ def create_from_main(_clsname, **kwargs):
     return get_factory().create_from_main(_clsname, **kwargs)
 
 
+def save_npy(fname, data):
+    """Save an array through a temporary file, so that concurrent jobs never
+    see a partial file.
+
+    Returns:
+        success: bool, False if the file could not be written (e.g. read-only
+        dataset folder).
+    """
+    tmp_fname = '{}.{}.tmp.npy'.format(fname[:-len('.npy')], os.getpid())
+    try:
+        np.save(tmp_fname, data)
+        os.rename(tmp_fname, fname)
+    except (IOError, OSError) as e:
+        logger.get().warning('Cannot write {}: {}'.format(fname, e))
+        return False
+    return True
+
+
+def get_output(out, key, shape, dtype='float32'):
+    """Get the array to write a batch value into.
+
+    Args:
+        out: dict of preallocated arrays, or None. An array may hold more
+        examples than the batch, and its dtype takes precedence.
+        key: string, batch key.
+        shape: list, shape of the batch value.
+        dtype: dtype to allocate with, when out has no array for key.
+
+    Returns:
+        arr: a view of out[key] of the batch size, a view of its memory
+        reshaped for batches of other shapes (e.g. bucketed image sizes), or
+        a new array if out[key] is too small.
+    """
+    if out is not None and key in out:
+        arr = out[key]
+        if arr.shape[1:] == tuple(shape[1:]) and arr.shape[0] >= shape[0]:
+            return arr[:shape[0]]
+        size = int(np.prod(shape))
+        if arr.flags['C_CONTIGUOUS'] and arr.size >= size:
+            return arr.reshape([-1])[:size].reshape(shape)
+        dtype = arr.dtype
+    return np.empty(shape, dtype=dtype)
+
+
+def take_batch(data, idx, out=None, key='x'):
+    """Gather examples along the first axis, into out[key] if given."""
+    arr = get_output(out, key, [len(idx)] + list(data.shape[1:]), data.dtype)
+    if arr.dtype == data.dtype:
+        np.take(data, idx, axis=0, out=arr)
+    else:
+        arr[...] = data[idx]
+    return arr
+
+
+def get_labels(labels, num_classes, sparse=False, out=None, key='y_gt'):
+    """Format a batch of class labels.
+
+    Args:
+        labels: [N] int, -1 where unknown.
+        num_classes: int.
+        sparse: bool, whether to output [N] int32 labels, instead of
+        [N, num_classes] float32 one-hot (all zeros where unknown).
+        out: dict of preallocated arrays, or None.
+        key: string, batch key.
+    """
+    labels = np.asarray(labels)
+    num = labels.shape[0]
+    if sparse:
+        arr = get_output(out, key, [num], 'int32')
+        arr[...] = labels
+    else:
+        arr = get_output(out, key, [num, num_classes], 'float32')
+        arr[...] = 0.0
+        known = labels >= 0
+        arr[np.arange(num)[known], labels[known]] = 1.0
+    return arr
+
+
 class DataProvider(OptionBase):
 
+    # Whether batches are given by their indices, so that batches can be built
+    # by several worker processes.
+    indexed = True
+
     def __init__(self):
         super(DataProvider, self).__init__()
         self._variables = None
@@ -49,6 +133,16 @@ class DataProvider(OptionBase):
         """Get number of examples."""
         raise Exception('Not implemented')
 
+    def reseed(self, seed):
+        """Reseed the random states owned by the provider, e.g. in a forked
+        worker process, so that workers draw differently. Providers with
+        random states override it.
+
+        Args:
+            seed: list of int.
+        """
+        pass
+
     def get_batch(self, **kwargs):
         """Get a batch of data.
         """
@@ -56,6 +150,9 @@ class DataProvider(OptionBase):
 
     def get_batch_idx(self, idx, **kwargs):
         """Get a batch of data.
+
+        Providers that support it take an `out` keyword argument, a dict of
+        preallocated arrays to fill in place, see get_output.
         """
         raise Exception('Not implemented')
 
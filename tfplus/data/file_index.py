@@ -0,0 +1,108 @@
+"""
+A compact binary index of file names and labels, cached next to a dataset so
+that large directory trees are only walked once.
+
+The names are stored as one byte blob with offsets, and the labels as int16.
+The index records the latest mtime of the paths it depends on, e.g. the
+scanned directory, its class subfolders and the label files, and is ignored
+once any of them changes.
+
+Usage:
+    mtime = file_index.get_mtime([folder] + subfolders + label_fnames)
+    result = file_index.load(fname, mtime)
+    if result is None:
+        ids, labels = scan()
+        file_index.save(fname, ids, labels, mtime)
+    else:
+        ids, labels = result
+"""
+
+import numpy as np
+import os
+
+from tfplus.utils import logger
+
+
+def get_mtime(paths):
+    """Get the latest mtime of a list of paths, skipping missing ones.
+
+    Only the given paths are stat'ed, not the files of a folder: list the
+    folders whose entries change, and rely on their own mtime for flat ones.
+    """
+    mtime = 0.0
+    for path in paths:
+        if os.path.exists(path):
+            mtime = max(mtime, os.path.getmtime(path))
+    return mtime
+
+
+class PackedStrings(object):
+    """A read-only list of strings, sliced out of a byte blob on access."""
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+        pass
+
+    def __len__(self):
+        return self._offsets.shape[0] - 1
+
+    def __getitem__(self, ii):
+        if ii < 0:
+            ii += len(self)
+        return self._blob[self._offsets[ii]: self._offsets[ii + 1]].tostring()
+
+    def __iter__(self):
+        for ii in xrange(len(self)):
+            yield self[ii]
+        pass
+    pass
+
+
+def save(fname, ids, labels, mtime):
+    """Save an index.
+
+    Args:
+        fname: string, index filename (.npz).
+        ids: list of string.
+        labels: list of int.
+        mtime: float, mtime of the scanned directory.
+
+    Returns:
+        success: bool, False if the index could not be written.
+    """
+    lengths = np.array([len(ii) for ii in ids], dtype='int64')
+    offsets = np.zeros([len(ids) + 1], dtype='int64')
+    offsets[1:] = np.cumsum(lengths)
+    blob = np.frombuffer(''.join(ids), dtype='uint8')
+    # Write to a temporary file first, so that concurrent readers never see
+    # a partial index.
+    tmp_fname = '{}.{}.tmp.npz'.format(fname[:-len('.npz')], os.getpid())
+    try:
+        np.savez(tmp_fname, blob=blob, offsets=offsets,
+                 labels=np.array(labels, dtype='int16'),
+                 mtime=np.array(mtime, dtype='float64'))
+        os.rename(tmp_fname, fname)
+    except (IOError, OSError) as e:
+        logger.get().warning('Cannot write file index {}: {}'.format(fname, e))
+        return False
+    return True
+
+
+def load(fname, mtime):
+    """Load an index.
+
+    Returns:
+        (ids, labels): PackedStrings and numpy array, or None if the index
+        does not exist or is stale.
+    """
+    if not os.path.exists(fname):
+        return None
+    data = np.load(fname)
+    try:
+        if float(data['mtime']) != mtime:
+            logger.get().info('File index {} is stale'.format(fname))
+            return None
+        return PackedStrings(data['blob'], data['offsets']), data['labels']
+    finally:
+        data.close()
@@ -8,6 +8,7 @@ import tensorflow as tf
 import tfplus
 import threading
 
+import file_index
 from img_preproc import ImagePreprocessor
 
 tfplus.cmd_args.add('imagenet:dataset_folder', 'str',
@@ -16,12 +17,16 @@ tfplus.cmd_args.add('imagenet:dataset_folder', 'str',
 
 class ImageNetDataProvider(tfplus.data.DataProvider):
 
-    def __init__(self, split='train', folder=None, mode='train'):
+    def __init__(self, split='train', folder=None, mode='train',
+                 sparse_labels=False, colour_backend='tf'):
         """
         Mode: train or valid or test
         Train: Random scale, random crop
         Valid: Single center crop
         Test: use 10-crop testing... Something that we haven't implemented yet.
+        sparse_labels: Output y_gt as [N] int32 labels (-1 on the test split)
+        instead of [N, 1000] one-hot.
+        colour_backend: 'tf' or 'numpy', see ImagePreprocessor.
         """
         super(ImageNetDataProvider, self).__init__()
         self.log = tfplus.utils.logger.get()
@@ -30,9 +35,10 @@ class ImageNetDataProvider(tfplus.data.DataProvider):
         self._img_ids = None
         self._labels = None
         self._mode = mode
+        self._sparse_labels = sparse_labels
         self._rnd_proc = ImagePreprocessor(
             rnd_hflip=True, rnd_colour=True, rnd_resize=[256, 480], resize=256,
-            crop=224)
+            crop=224, colour_backend=colour_backend)
         self._mutex = threading.Lock()
         self.register_option('imagenet:dataset_folder')
         pass
@@ -52,38 +58,70 @@ class ImageNetDataProvider(tfplus.data.DataProvider):
     @property
     def img_ids(self):
         if self._img_ids is None:
-            _img_ids = []
-            _labels = []
             image_folder = os.path.join(self.folder, self.split)
-            if self.split == 'train':
-                folders = os.listdir(image_folder)
-                for ff in folders:
-                    subfolder = os.path.join(image_folder, ff)
-                    image_fnames = os.listdir(subfolder)
-                    _img_ids.extend(image_fnames)
-                    _labels.extend(
-                        [synset.get_index(ff)] * len(image_fnames))
-            elif self.split == 'valid' or self.split == 'test':
-                _img_ids = os.listdir(image_folder)
-                _img_ids = sorted(_img_ids)
-                if self.split == 'valid':
-                    with open(os.path.join(
-                            self.folder, 'synsets.txt'), 'r') as f_cls:
-                        synsets = f_cls.readlines()
-                    synsets = [ss.strip('\n') for ss in synsets]
-                    with open(os.path.join(
-                            self.folder, 'valid_labels.txt'), 'r') as f_lab:
-                        labels = f_lab.readlines()
-                    labels = [int(ll) for ll in labels]
-                    slabels = [synsets[ll] for ll in labels]
-                    _labels = [synset.get_index(sl) for sl in slabels]
-            _labels = np.array(_labels)
+            index_fname = os.path.join(
+                self.folder, '{}_ids.npz'.format(self.split))
+            mtime = file_index.get_mtime(self.get_index_deps())
+            index = file_index.load(index_fname, mtime)
+            if index is None:
+                _img_ids, _labels = self.scan_img_ids()
+                file_index.save(index_fname, _img_ids, _labels, mtime)
+            else:
+                _img_ids, _labels = index
             self._mutex.acquire()
             self._img_ids = _img_ids
             self._labels = _labels
             self._mutex.release()
         return self._img_ids
 
+    def reseed(self, seed):
+        self._rnd_proc.reseed(seed)
+        pass
+
+    def get_index_deps(self):
+        """Get the paths that the id index depends on: the split folder,
+        the class subfolders of train, and the label files of valid."""
+        image_folder = os.path.join(self.folder, self.split)
+        deps = [image_folder]
+        if self.split == 'train':
+            deps.extend([os.path.join(image_folder, ff)
+                         for ff in os.listdir(image_folder)])
+        elif self.split == 'valid':
+            deps.append(os.path.join(self.folder, 'synsets.txt'))
+            deps.append(os.path.join(self.folder, 'valid_labels.txt'))
+        return deps
+
+    def scan_img_ids(self):
+        """Walk the image folder for the image ids and labels."""
+        _img_ids = []
+        _labels = []
+        image_folder = os.path.join(self.folder, self.split)
+        self.log.info('Scanning {}'.format(image_folder))
+        if self.split == 'train':
+            folders = os.listdir(image_folder)
+            for ff in folders:
+                subfolder = os.path.join(image_folder, ff)
+                image_fnames = os.listdir(subfolder)
+                _img_ids.extend(image_fnames)
+                _labels.extend(
+                    [synset.get_index(ff)] * len(image_fnames))
+        elif self.split == 'valid' or self.split == 'test':
+            _img_ids = os.listdir(image_folder)
+            _img_ids = sorted(_img_ids)
+            if self.split == 'valid':
+                with open(os.path.join(
+                        self.folder, 'synsets.txt'), 'r') as f_cls:
+                    synsets = f_cls.readlines()
+                synsets = [ss.strip('\n') for ss in synsets]
+                with open(os.path.join(
+                        self.folder, 'valid_labels.txt'), 'r') as f_lab:
+                    labels = f_lab.readlines()
+                labels = [int(ll) for ll in labels]
+                slabels = [synsets[ll] for ll in labels]
+                _labels = [synset.get_index(sl) for sl in slabels]
+        _labels = np.array(_labels)
+        return _img_ids, _labels
+
     @property
     def labels(self):
         if self._labels is None and self.split != 'test':
@@ -93,28 +131,45 @@ class ImageNetDataProvider(tfplus.data.DataProvider):
     def get_size(self):
         return len(self.img_ids)
 
-    def get_batch_idx(self, idx, **kwargs):
+    def get_fname(self, ii):
+        """Get the image filename of an example."""
+        if self.split == 'train':
+            folder = os.path.join('train', self.img_ids[ii].split('_')[0])
+        else:
+            folder = self.split
+        return os.path.join(self.folder, folder, self.img_ids[ii])
+
+    def get_batch_labels(self, idx, out=None):
+        """Get the y_gt of a batch."""
+        if self.split == 'test':
+            labels = np.zeros([len(idx)], dtype='int64') - 1
+        else:
+            labels = self.labels[idx]
+        return tfplus.data.data_provider.get_labels(
+            labels, 1000, sparse=self._sparse_labels, out=out)
+
+    def get_batch_images(self, images, out=None):
+        """Preprocess the images of a batch, into out['x'] if given."""
+        x = tfplus.data.data_provider.get_output(
+            out, 'x', [len(images), self._rnd_proc.crop,
+                       self._rnd_proc.crop, 3])
+        return self._rnd_proc.process_batch(
+            images, rnd=self._mode == 'train', out=x)
+
+    def get_batch_idx(self, idx, out=None, **kwargs):
         start_time = time.time()
-        x = None
-        y_gt = np.zeros([len(idx), 1000], dtype='float32')
+        prof = tfplus.utils.profiler.get()
+        images = []
         for kk, ii in enumerate(idx):
-            if self.split == 'train':
-                folder = os.path.join('train', self.img_ids[ii].split('_')[0])
-            else:
-                folder = self.split
-            img_fname = os.path.join(self.folder, folder, self.img_ids[ii])
+            img_fname = self.get_fname(ii)
             # self.log.info('Image filename: {}'.format(img_fname))
-            x_ = cv2.imread(img_fname)
-            rnd = self._mode == 'train'
-            x_, rnd_package = self._rnd_proc.process(x_, rnd=rnd)
-            if x is None:
-                x = np.zeros([len(idx), x_.shape[0], x_.shape[1], x_.shape[2]],
-                             dtype='float32')
-            x[kk] = x_
-            y_gt[kk, self.labels[ii]] = 1.0
+            with prof.timer('read'):
+                buf = np.fromfile(img_fname, dtype='uint8')
+            with prof.timer('decode'):
+                images.append(cv2.imdecode(buf, cv2.IMREAD_COLOR))
         results = {
-            'x': x,
-            'y_gt': y_gt
+            'x': self.get_batch_images(images, out=out),
+            'y_gt': self.get_batch_labels(idx, out=out)
         }
         # self.log.info('Fetch data time: {:.4f} ms'.format(
         #               (time.time() - start_time) * 1000))
@@ -0,0 +1,171 @@
+"""
+Pre-decoded, memory-mapped ImageNet cache.
+
+The conversion packs the images, resized to a fixed short side and stored as
+uint8 BGR pixels, into one flat binary file per split, along with an index of
+offsets, sizes and labels. Reading a sample is then a page-cache read, with no
+JPEG decoding and no directory listing.
+
+Usage:
+    # One-time conversion.
+    python imagenet_cache.py --split train
+    # Training.
+    data = tfplus.data.create_from_main('imagenet_cache', split='train')
+"""
+from __future__ import division
+
+import cv2
+import numpy as np
+import os
+import tfplus
+
+from imagenet import ImageNetDataProvider
+
+tfplus.cmd_args.add('imagenet:cache_folder', 'str', None)
+
+
+def get_cache_fnames(folder, split):
+    """Get the data and index filenames of a split."""
+    return (os.path.join(folder, split + '.bin'),
+            os.path.join(folder, split + '_index.npz'))
+
+
+def resize_short(image, short_side):
+    height = image.shape[0]
+    width = image.shape[1]
+    if width < height:
+        siz = (short_side, int(height / width * short_side))
+    else:
+        siz = (int(width / height * short_side), short_side)
+    return cv2.resize(image, siz, interpolation=cv2.INTER_CUBIC)
+
+
+def pack(data_provider, folder, short_side=256):
+    """Pack an ImageNet split into the cache format.
+
+    Args:
+        data_provider: ImageNetDataProvider, split to pack.
+        folder: string, output folder.
+        short_side: int, short side of the stored images.
+    """
+    log = tfplus.utils.logger.get()
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    data_fname, index_fname = get_cache_fnames(folder, data_provider.split)
+    num = data_provider.get_size()
+    offsets = np.zeros([num], dtype='int64')
+    sizes = np.zeros([num, 2], dtype='int32')
+    labels = data_provider.labels
+    if labels is None:
+        labels = np.zeros([num], dtype='int16') - 1
+    offset = 0
+    # Write to temporary files first, so that readers never see a partial
+    # cache. The data file is renamed last, so that a complete data file
+    # always comes with its index.
+    tmp_data_fname = '{}.{}.tmp'.format(data_fname, os.getpid())
+    tmp_index_fname = '{}.{}.tmp.npz'.format(index_fname[:-len('.npz')],
+                                             os.getpid())
+    with open(tmp_data_fname, 'wb') as f:
+        for ii in xrange(num):
+            img = resize_short(
+                cv2.imread(data_provider.get_fname(ii)), short_side)
+            img = np.ascontiguousarray(img, dtype='uint8')
+            f.write(img.tobytes())
+            offsets[ii] = offset
+            sizes[ii] = img.shape[:2]
+            offset += img.nbytes
+            if (ii + 1) % 1000 == 0:
+                log.info('Packed {:d}/{:d} images'.format(ii + 1, num))
+    np.savez(tmp_index_fname, offsets=offsets, sizes=sizes,
+             labels=np.array(labels, dtype='int16'),
+             short_side=np.array(short_side))
+    os.rename(tmp_index_fname, index_fname)
+    os.rename(tmp_data_fname, data_fname)
+    log.info('Packed {:d} images, {:.2f} GB, to {}'.format(
+        num, offset / 1024 / 1024 / 1024, data_fname))
+    pass
+
+
+class ImageNetCacheDataProvider(ImageNetDataProvider):
+    """Reads images from the cache written by `pack`."""
+
+    def __init__(self, split='train', folder=None, mode='train',
+                 cache_folder=None, sparse_labels=False, colour_backend='tf'):
+        super(ImageNetCacheDataProvider, self).__init__(
+            split=split, folder=folder, mode=mode,
+            sparse_labels=sparse_labels, colour_backend=colour_backend)
+        self._cache_folder = cache_folder
+        self._data = None
+        self._offsets = None
+        self._sizes = None
+        self.register_option('imagenet:cache_folder')
+        pass
+
+    @property
+    def cache_folder(self):
+        if self._cache_folder is None:
+            cache_folder = self.get_option('imagenet:cache_folder')
+            if cache_folder is None:
+                cache_folder = os.path.join(self.folder, 'cache')
+            self._cache_folder = cache_folder
+        return self._cache_folder
+
+    def init_data(self):
+        self._mutex.acquire()
+        try:
+            if self._data is None:
+                data_fname, index_fname = get_cache_fnames(
+                    self.cache_folder, self.split)
+                index = np.load(index_fname)
+                self._offsets = index['offsets']
+                self._sizes = index['sizes']
+                self._labels = index['labels']
+                self._data = np.memmap(data_fname, dtype='uint8', mode='r')
+        finally:
+            self._mutex.release()
+        pass
+
+    @property
+    def labels(self):
+        if self._data is None:
+            self.init_data()
+        if self.split == 'test':
+            return None
+        return self._labels
+
+    def get_size(self):
+        if self._data is None:
+            self.init_data()
+        return self._offsets.shape[0]
+
+    def get_image(self, ii):
+        """Get a view of a stored image, [H, W, 3] uint8 BGR."""
+        if self._data is None:
+            self.init_data()
+        height, width = self._sizes[ii]
+        start = self._offsets[ii]
+        end = start + height * width * 3
+        return self._data[start: end].reshape([height, width, 3])
+
+    def get_batch_idx(self, idx, out=None, **kwargs):
+        images = [self.get_image(ii) for ii in idx]
+        return {
+            'x': self.get_batch_images(images, out=out),
+            'y_gt': self.get_batch_labels(idx, out=out)
+        }
+    pass
+
+
+tfplus.data.data_provider.get_factory().register('imagenet_cache',
+                                                 ImageNetCacheDataProvider)
+
+if __name__ == '__main__':
+    tfplus.init('Pack ImageNet into a memory-mapped cache')
+    tfplus.cmd_args.add('split', 'str', 'train')
+    tfplus.cmd_args.add('short_side', 'int', 256)
+    opt = tfplus.cmd_args.make()
+    data = ImageNetDataProvider(split=opt['split']).init_from_main()
+    cache_folder = opt['imagenet:cache_folder']
+    if cache_folder is None:
+        cache_folder = os.path.join(data.folder, 'cache')
+    pack(data, cache_folder, short_side=opt['short_side'])
@@ -1,15 +1,23 @@
 from __future__ import division
 
+import colour
 import cv2
 import numpy as np
 import tensorflow as tf
+import threading
+
+from tfplus.utils import profiler
 
 
 class ImagePreprocessor(object):
 
     def __init__(self, resize=256, rnd_hflip=True, rnd_resize=[256, 480],
-                 crop=224, rnd_colour=True, resize_base='short'):
+                 crop=224, rnd_colour=True, resize_base='short',
+                 colour_backend='tf'):
         """
+        colour_backend: 'tf' runs the random colour ops in a private
+        TensorFlow session, 'numpy' runs the equivalent NumPy/OpenCV ops in
+        the calling thread, see colour.py.
         """
         self._random = np.random.RandomState(2)
         # readonly
@@ -24,8 +32,16 @@ class ImagePreprocessor(object):
         self._rnd_colour = rnd_colour
         # readonly
         self._resize_base = resize_base
-        self._image_in, self._image_out = self.build_colour_graph()
-        self._sess = tf.Session()
+        if colour_backend not in ['tf', 'numpy']:
+            raise Exception('Unknown colour backend {}'.format(colour_backend))
+        # readonly
+        self._colour_backend = colour_backend
+        # The colour graph and session are only built for the TF backend, on
+        # first use.
+        self._image_in = None
+        self._image_out = None
+        self._sess = None
+        self._sess_lock = threading.Lock()
         pass
 
     @property
@@ -48,6 +64,10 @@ class ImagePreprocessor(object):
     def random(self):
         return self._random
 
+    def reseed(self, seed):
+        self._random.seed(seed)
+        pass
+
     @property
     def rnd_colour(self):
         return self._rnd_colour
@@ -56,18 +76,61 @@ class ImagePreprocessor(object):
     def resize_base(self):
         return self._resize_base
 
+    @property
+    def colour_backend(self):
+        return self._colour_backend
+
     @property
     def image_in(self):
+        if self._image_in is None:
+            self.init_colour_graph()
         return self._image_in
 
     @property
     def image_out(self):
+        if self._image_out is None:
+            self.init_colour_graph()
         return self._image_out
 
     @property
     def sess(self):
+        if self._sess is None:
+            self.init_colour_graph()
         return self._sess
 
+    def init_colour_graph(self):
+        self._sess_lock.acquire()
+        try:
+            if self._sess is None:
+                graph = tf.Graph()
+                with graph.as_default():
+                    self._image_in, self._image_out = \
+                        self.build_colour_graph()
+                self._sess = tf.Session(graph=graph)
+        finally:
+            self._sess_lock.release()
+        pass
+
+    def random_colour(self, images, bgr=False):
+        """Apply random colours to a batch of images, in place.
+
+        Args:
+            images: [N, H, W, 3] float32 in [0, 1], C-contiguous.
+            bgr: bool, channel order of the images.
+        """
+        if self.colour_backend == 'numpy':
+            return colour.random_colour(images, self.random, bgr=bgr)
+        for kk in xrange(images.shape[0]):
+            image = images[kk]
+            if bgr:
+                image = image[:, :, [2, 1, 0]]
+            image = self.sess.run(self.image_out, feed_dict={
+                self.image_in: image})
+            if bgr:
+                image = image[:, :, [2, 1, 0]]
+            images[kk] = image
+        return images
+
     def build_colour_graph(self):
         """Build random colour graph."""
         device = '/cpu:0'
@@ -129,6 +192,114 @@ class ImagePreprocessor(object):
             'hflip': hflip
         }
 
+    def redraw_batch(self, old_sizes):
+        """Draw the random numbers of a whole batch in one go.
+
+        Args:
+            old_sizes: list of (width, height).
+
+        Returns:
+            rnd_packages: list of dict, see redraw.
+        """
+        num = len(old_sizes)
+        siz = self.random.uniform(
+            self.rnd_resize[0], self.rnd_resize[1], num).astype('int')
+        rnd_offset = self.random.uniform(0.0, 1.0, [num, 2])
+        hflip = self.random.uniform(0, 1, num) > 0.5
+        rnd_packages = []
+        for kk in xrange(num):
+            siz2, pad, ratio = self.get_resize(old_sizes[kk], int(siz[kk]))
+            siz3 = [siz2[0] + pad[0], siz2[1] + pad[1]]
+            offset = [int(rnd_offset[kk, 0] * (siz3[0] - self.crop)),
+                      int(rnd_offset[kk, 1] * (siz3[1] - self.crop))]
+            rnd_packages.append({
+                'offset': offset,
+                'pad': pad,
+                'ratio': ratio,
+                'resize': siz2,
+                'hflip': bool(hflip[kk])
+            })
+        return rnd_packages
+
+    def crop_into(self, dst, image, pad, offset, hflip):
+        """Copy the crop window of an image into dst.
+
+        The image is virtually padded with zeros, and the padding never gets
+        allocated.
+        """
+        crop = self.crop
+        height = image.shape[0] + 2 * pad[1]
+        width = image.shape[1] + 2 * pad[0]
+        # Window corner in image coordinates.
+        if height == crop and width == crop:
+            y0 = -pad[1]
+            x0 = -pad[0]
+        else:
+            y0 = offset[1] - pad[1]
+            x0 = offset[0] - pad[0]
+        sy0 = max(y0, 0)
+        sx0 = max(x0, 0)
+        sy1 = min(y0 + crop, image.shape[0])
+        sx1 = min(x0 + crop, image.shape[1])
+        if hflip:
+            dst = dst[:, ::-1]
+        if sy0 > y0 or sx0 > x0 or sy1 < y0 + crop or sx1 < x0 + crop:
+            dst[...] = 0.0
+        if sy1 > sy0 and sx1 > sx0:
+            dst[sy0 - y0: sy1 - y0, sx0 - x0: sx1 - x0] = \
+                image[sy0: sy1, sx0: sx1]
+        pass
+
+    def process_batch(self, images, rnd=True, out=None):
+        """Process a batch of images.
+
+        Same transformations as process, but the random numbers are drawn for
+        the whole batch at once, and the crops are written straight into the
+        output. With the NumPy colour backend, colour jitter runs on the whole
+        batch at once.
+
+        Args:
+            images: list of [H, W, C] BGR images in [0, 255].
+            rnd: bool, random or centre crop.
+            out: [N, crop, crop, C] float32, C-contiguous output buffer.
+            Allocated if None.
+
+        Returns:
+            out: [N, crop, crop, C] float32 BGR in [0, 1].
+        """
+        num = len(images)
+        if out is None:
+            out = np.empty([num, self.crop, self.crop, images[0].shape[2]],
+                           dtype='float32')
+        prof = profiler.get()
+        sizes = [(image.shape[1], image.shape[0]) for image in images]
+        if rnd:
+            rnd_packages = self.redraw_batch(sizes)
+        with prof.timer('resize_crop'):
+            for kk, image in enumerate(images):
+                if rnd:
+                    resize = rnd_packages[kk]['resize']
+                    offset = rnd_packages[kk]['offset']
+                    pad = rnd_packages[kk]['pad']
+                    hflip = rnd_packages[kk]['hflip'] and self.rnd_hflip
+                else:
+                    resize, pad, ratio = self.get_resize(sizes[kk],
+                                                         self.resize)
+                    offset = [0, 0]
+                    if self.resize_base == 'short':
+                        offset[0] = int((resize[0] - self.crop) / 2)
+                        offset[1] = int((resize[1] - self.crop) / 2)
+                    hflip = False
+                image = cv2.resize(image, resize,
+                                   interpolation=cv2.INTER_CUBIC)
+                self.crop_into(out[kk], image, pad, offset, hflip)
+            # [0, 255] => [0, 1]
+            out *= 1 / 255
+        if rnd and self.rnd_colour and out.shape[-1] == 3:
+            with prof.timer('colour'):
+                self.random_colour(out, bgr=True)
+        return out
+
     def process(self, image, rnd=True, rnd_package=None):
         """Process the images.
 
@@ -168,22 +339,30 @@ class ImagePreprocessor(object):
                 offset[1] = int((resize[1] - self.crop) / 2)
             hflip = False
 
-        image = cv2.resize(image, resize, interpolation=cv2.INTER_CUBIC)
+        prof = profiler.get()
+        with prof.timer('resize_crop'):
+            image = cv2.resize(image, resize, interpolation=cv2.INTER_CUBIC)
 
-        if pad[0] > 0 or pad[1] > 0:
-            image = np.pad(image, [[pad[1], pad[1]], [pad[0], pad[0]], [0, 0]],
-                           'constant', constant_values=(0,))
+            if pad[0] > 0 or pad[1] > 0:
+                image = np.pad(image, [[pad[1], pad[1]], [pad[0], pad[0]],
+                                       [0, 0]],
+                               'constant', constant_values=(0,))
 
-        if image.shape[0] != self.crop or image.shape[1] != self.crop:
-            image = image[offset[1]: self.crop + offset[1],
-                          offset[0]: self.crop + offset[0], :]
+            if image.shape[0] != self.crop or image.shape[1] != self.crop:
+                image = image[offset[1]: self.crop + offset[1],
+                              offset[0]: self.crop + offset[0], :]
 
-        if hflip:
-            image = np.fliplr(image)
+            if hflip:
+                image = np.fliplr(image)
 
         if rnd and self.rnd_colour and image.shape[-1] == 3:
-            image = self.sess.run(self.image_out, feed_dict={
-                self.image_in: image})
+            with prof.timer('colour'):
+                if self.colour_backend == 'numpy':
+                    image = np.ascontiguousarray(image)
+                    image = colour.random_colour(image[None], self.random)[0]
+                else:
+                    image = self.sess.run(self.image_out, feed_dict={
+                        self.image_in: image})
         # RGB => BGR
         image = image[:, :, [2, 1, 0]]
 
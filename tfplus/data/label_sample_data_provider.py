@@ -1,16 +1,43 @@
 from data_provider import DataProvider
 import numpy as np
+import threading
 import tfplus
 
 
 class LabelSampleDataProvider(DataProvider):
 
-    def __init__(self, data_provider, mode='train'):
+    def __init__(self, data_provider, mode='train', class_weights=None,
+                 epoch_size=None):
+        """
+        Args:
+            data_provider: DataProvider with a label_idx dict, class =>
+            example indices.
+            mode: 'train' to draw class-balanced examples, or anything else to
+            iterate the whole dataset.
+            class_weights: [num_classes] sampling weights of the classes, in
+            the order of the sorted label_idx keys. By default, the class of
+            each example is given by its index, so that classes are equally
+            represented.
+            epoch_size: int, number of examples per epoch in train mode,
+            default num_classes * 10000.
+        """
         super(LabelSampleDataProvider, self).__init__()
         self._data_provider = data_provider
         self._rnd = np.random.RandomState(2)
         self._mode = mode
         self._real_size = len(self.data_provider.label_idx.keys())
+        self._epoch_size = epoch_size
+        self._class_cdf = None
+        if class_weights is not None:
+            if len(class_weights) != self._real_size:
+                raise Exception('Expected {} class weights, got {}'.format(
+                    self._real_size, len(class_weights)))
+            class_cdf = np.cumsum(class_weights, dtype='float64')
+            self._class_cdf = class_cdf / class_cdf[-1]
+        self._flat_idx = None
+        self._class_start = None
+        self._class_count = None
+        self._csr_lock = threading.Lock()
         self.log = tfplus.utils.logger.get()
         pass
 
@@ -26,27 +53,69 @@ class LabelSampleDataProvider(DataProvider):
     def data_provider(self):
         return self._data_provider
 
+    @property
+    def indexed(self):
+        return self.data_provider.indexed
+
+    def reseed(self, seed):
+        self._rnd.seed(seed)
+        self.data_provider.reseed(list(seed) + [1])
+        pass
+
+    def init_csr(self):
+        """Lay out the example indices of all classes in one flat array, with
+        per-class offsets."""
+        self._csr_lock.acquire()
+        try:
+            if self._flat_idx is None:
+                label_idx = self.data_provider.label_idx
+                groups = [np.asarray(label_idx[key], dtype='int64')
+                          for key in sorted(label_idx.keys())]
+                class_count = np.array([len(gg) for gg in groups],
+                                       dtype='int64')
+                if (class_count == 0).any():
+                    raise Exception('Empty classes: {}'.format(
+                        np.nonzero(class_count == 0)[0]))
+                self._class_start = np.cumsum(class_count) - class_count
+                self._class_count = class_count
+                self._flat_idx = np.concatenate(groups)
+        finally:
+            self._csr_lock.release()
+        pass
+
     def get_size(self):
         if self.mode == 'train':
             # Only iterating the keys (equalize the weights between different
             # classes).
+            if self._epoch_size is not None:
+                return self._epoch_size
             return self._real_size * 10000
         else:
             # Iterating the whole dataset.
             return self.data_provider.get_size()
 
+    def sample_idx(self, idx):
+        """Draw one example per index, from the class of each index."""
+        if self._flat_idx is None:
+            self.init_csr()
+        num = len(idx)
+        if self._class_cdf is None:
+            cls = np.asarray(idx, dtype='int64') % self._real_size
+        else:
+            cls = np.searchsorted(self._class_cdf, self.rnd.uniform(0, 1, num),
+                                  side='right')
+            np.minimum(cls, self._real_size - 1, out=cls)
+        count = self._class_count[cls]
+        kk = (self.rnd.uniform(0, 1, num) * count).astype('int64')
+        # Guard against the uniform draw rounding up to count.
+        np.minimum(kk, count - 1, out=kk)
+        return self._flat_idx[self._class_start[cls] + kk]
+
     def get_batch_idx(self, idx, **kwargs):
         if self.mode == 'train':
-            new_idx = []
-            # self.log.info('Label IDX: {}'.format(idx))
-            for ii in idx:
-                ii_ = ii % self._real_size
-                data_group = self.data_provider.label_idx[ii_]
-                num_ids = len(data_group)
-                kk = int(np.floor(self.rnd.uniform(0, num_ids)))
-                new_idx.append(data_group[kk])
+            new_idx = self.sample_idx(idx)
             # self.log.info('Ex IDX: {}'.format(new_idx))
         else:
             # self.log.info('Eval mode idx: {}'.format(idx))
             new_idx = idx
-        return self.data_provider.get_batch_idx(new_idx)
+        return self.data_provider.get_batch_idx(new_idx, **kwargs)
@@ -2,23 +2,71 @@ from __future__ import division
 
 import cv2
 import numpy as np
+import os
 import threading
+from PIL import Image
 import data_provider
 from data_provider import DataProvider
+from tfplus.utils import logger
+from tfplus.utils import profiler
+
+
+def assign_buckets(sizes, shapes):
+    """Assign images to the shape of the closest aspect ratio.
+
+    Args:
+        sizes: [N, 2] (height, width) of the images.
+        shapes: list of (height, width).
+
+    Returns:
+        buckets: [N] int, index into shapes.
+    """
+    sizes = np.asarray(sizes, dtype='float64')
+    shapes = np.asarray(shapes, dtype='float64')
+    ratio = np.log(sizes[:, 1] / sizes[:, 0])
+    shape_ratio = np.log(shapes[:, 1] / shapes[:, 0])
+    return np.abs(ratio[:, None] - shape_ratio[None, :]).argmin(axis=1)
 
 
 class ListImageDataProvider(DataProvider):
     """
     Pass in a list of image file path in a plain text file.
+
+    With bucket_shapes, every image is resized to the shape of the closest
+    aspect ratio, and batches take the shape of their first image. Iterate with
+    a BucketSampler on get_buckets() so that batches hold a single bucket:
+
+        sampler = BucketSampler(data.get_buckets(), batch_size)
+        BatchIterator(data.get_size(), batch_size, sampler=sampler, ...)
     """
 
-    def __init__(self, fname, inp_height=None, inp_width=None):
+    def __init__(self, fname, inp_height=None, inp_width=None, cache=None,
+                 cache_dtype='float32', bucket_shapes=None):
+        """
+        Args:
+            fname: string, list file.
+            inp_height: int, height of the resized images.
+            inp_width: int, width of the resized images.
+            bucket_shapes: list of (height, width), overrides inp_height and
+            inp_width.
+            cache: SampleCache of the resized images, or None.
+            cache_dtype: 'float32' to cache the images as output, or 'uint8'
+            to cache a quarter of the bytes, resized before the conversion to
+            float (slightly different rounding).
+        """
         super(ListImageDataProvider, self).__init__()
         self._ids = None
         self._fname = fname
         self._id_lock = threading.Lock()
         self._inp_height = inp_height
         self._inp_width = inp_width
+        if cache_dtype not in ['float32', 'uint8']:
+            raise Exception('Unknown cache dtype {}'.format(cache_dtype))
+        self._cache = cache
+        self._cache_dtype = cache_dtype
+        self._bucket_shapes = bucket_shapes
+        self._sizes = None
+        self._buckets = None
         pass
 
     @property
@@ -47,25 +95,117 @@ class ListImageDataProvider(DataProvider):
     def inp_width(self):
         return self._inp_width
 
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def bucket_shapes(self):
+        return self._bucket_shapes
+
+    def get_sizes(self):
+        """Get the (height, width) of all images.
+
+        The sizes are read once from the image headers and saved next to the
+        list file, until the list file changes.
+
+        Returns:
+            sizes: [N, 2] int.
+        """
+        if self._sizes is not None:
+            return self._sizes
+        size_fname = self.fname + '.sizes.npz'
+        mtime = os.path.getmtime(self.fname)
+        sizes = None
+        if os.path.exists(size_fname):
+            data = np.load(size_fname)
+            if float(data['mtime']) == mtime:
+                sizes = data['sizes']
+        if sizes is None:
+            log = logger.get()
+            log.info('Reading the image sizes of {}'.format(self.fname))
+            sizes = np.zeros([len(self.ids), 2], dtype='int32')
+            for ii, fname in enumerate(self.ids):
+                # Only the header is read, the image is not decoded.
+                with open(fname, 'rb') as f:
+                    width, height = Image.open(f).size
+                sizes[ii] = (height, width)
+            # Write to a temporary file first, so that concurrent readers
+            # never see a partial file.
+            tmp_fname = '{}.{}.tmp.npz'.format(
+                size_fname[:-len('.npz')], os.getpid())
+            try:
+                np.savez(tmp_fname, sizes=sizes,
+                         mtime=np.array(mtime, dtype='float64'))
+                os.rename(tmp_fname, size_fname)
+            except (IOError, OSError) as e:
+                log.warning('Cannot write {}: {}'.format(size_fname, e))
+        self._sizes = sizes
+        return self._sizes
+
+    def get_buckets(self):
+        """Get the bucket of every image, an index into bucket_shapes."""
+        if self._buckets is None:
+            if self.bucket_shapes is None:
+                raise Exception('No bucket shapes')
+            self._buckets = assign_buckets(self.get_sizes(),
+                                           self.bucket_shapes)
+        return self._buckets
+
+    def read_image(self, fname, hh, ww):
+        """Read and resize an image.
+
+        Returns:
+            x: [hh, ww, 3] float32, or uint8 with cache_dtype uint8.
+            orig_size: (height, width) of the original image.
+        """
+        prof = profiler.get()
+        with prof.timer('read'):
+            buf = np.fromfile(fname, dtype='uint8')
+        with prof.timer('decode'):
+            x_ = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        orig_size = (x_.shape[0], x_.shape[1])
+        with prof.timer('resize_crop'):
+            if self._cache_dtype == 'float32':
+                x_ = x_.astype('float32') / 255
+            x_ = cv2.resize(x_, (ww, hh), interpolation=cv2.INTER_CUBIC)
+        return x_, orig_size
+
+    def get_image(self, fname, hh, ww):
+        """Read and resize an image, through the cache if any."""
+        if self.cache is None:
+            return self.read_image(fname, hh, ww)
+        key = (fname, os.path.getmtime(fname), hh, ww)
+        result = self.cache.get(key)
+        if result is None:
+            x_, orig_size = self.read_image(fname, hh, ww)
+            self.cache.put(key, x_, orig_size)
+            result = x_, orig_size
+        return result
+
     def get_size(self):
         return len(self.ids)
 
-    def get_batch_idx(self, idx):
-        hh = self.inp_height
-        ww = self.inp_width
-        x = np.zeros([len(idx), hh, ww, 3], dtype='float32')
+    def get_batch_idx(self, idx, out=None, **kwargs):
+        if self.bucket_shapes is None:
+            hh = self.inp_height
+            ww = self.inp_width
+        else:
+            hh, ww = self.bucket_shapes[self.get_buckets()[idx[0]]]
+        x = data_provider.get_output(out, 'x', [len(idx), hh, ww, 3])
         orig_height = []
         orig_width = []
         ids = []
         for kk, ii in enumerate(idx):
             fname = self.ids[ii]
             ids.append('{:06}'.format(ii))
-            x_ = cv2.imread(fname).astype('float32') / 255
-            x[kk] = cv2.resize(
-                x_, (self.inp_width, self.inp_height),
-                interpolation=cv2.INTER_CUBIC)
-            orig_height.append(x_.shape[0])
-            orig_width.append(x_.shape[1])
+            x_, orig_size = self.get_image(fname, hh, ww)
+            if x_.dtype == np.uint8:
+                np.multiply(x_, 1 / 255, out=x[kk], casting='unsafe')
+            else:
+                x[kk] = x_
+            orig_height.append(orig_size[0])
+            orig_width.append(orig_size[1])
             pass
         return {
             'x': x,
@@ -32,7 +32,7 @@ def maybe_download(filename, work_directory):
 
 def _read32(bytestream):
     dt = numpy.dtype(numpy.uint32).newbyteorder('>')
-    return numpy.frombuffer(bytestream.read(4), dtype=dt)
+    return numpy.frombuffer(bytestream.read(4), dtype=dt)[0]
 
 
 def extract_images(filename):
@@ -81,6 +81,29 @@ def extract_labels(filename, one_hot=False):
         return labels
 
 
+def get_npy_fname(gz_fname):
+    """Get the uncompressed filename of an idx file."""
+    return gz_fname[:-len('.gz')].rsplit('-idx', 1)[0] + '.npy'
+
+
+def convert(gz_fname, extract_fn):
+    """Convert a gzipped idx file to an uncompressed .npy file, once, and
+    memory-map it.
+
+    Returns:
+        data: numpy array, memory-mapped, or in memory if the .npy file could
+        not be written.
+    """
+    npy_fname = get_npy_fname(gz_fname)
+    if not os.path.exists(npy_fname):
+        data = extract_fn(gz_fname)
+        if not data_provider.save_npy(npy_fname, data):
+            return data
+        log = logger.get()
+        log.info('Converted {} to {}'.format(gz_fname, npy_fname))
+    return numpy.load(npy_fname, mmap_mode='r')
+
+
 class MNISTDataProvider(data_provider.DataProvider):
 
     def __init__(self, split='train', filename=None):
@@ -117,43 +140,52 @@ class MNISTDataProvider(data_provider.DataProvider):
             else:
                 raise Exception('Unknown split "{}"'.format(self.split))
         else:
-            self.image_filename = filename + '-images-idx3-ubyte.gz'
-            self.label_filename = filename + '-labels-idx1-ubyte.gz'
-
-        local_file = maybe_download(self.image_filename, self.folder)
-        self._images = extract_images(local_file)
-        local_file = maybe_download(self.label_filename, self.folder)
-        self._labels = extract_labels(
-            local_file, one_hot=self.get_option('one_hot'))
+            self.image_filename = self.filename + '-images-idx3-ubyte.gz'
+            self.label_filename = self.filename + '-labels-idx1-ubyte.gz'
+
+        # The images and labels are converted to .npy files on first use,
+        # then memory-mapped, so that concurrent jobs share one page-cached
+        # copy.
+        image_fname = os.path.join(self.folder, self.image_filename)
+        if not os.path.exists(get_npy_fname(image_fname)):
+            maybe_download(self.image_filename, self.folder)
+        images = convert(image_fname, extract_images)
+        label_fname = os.path.join(self.folder, self.label_filename)
+        if not os.path.exists(get_npy_fname(label_fname)):
+            maybe_download(self.label_filename, self.folder)
+        labels = convert(label_fname, extract_labels)
+        # Views of the examples of the split.
+        if self.split == 'train':
+            images = images[VALIDATION_SIZE:]
+            labels = labels[VALIDATION_SIZE:]
+        elif self.split == 'valid':
+            images = images[:VALIDATION_SIZE]
+            labels = labels[:VALIDATION_SIZE]
+        self._labels = labels
+        self._images = images
         pass
 
     def get_size(self):
         if self._images is None:
             self.init_data()
-        if self.split == 'valid':
-            size = VALIDATION_SIZE
-        elif self.split == 'train':
-            size = self._images.shape[0] - VALIDATION_SIZE
-        else:
-            size = self._images.shape[0]
+        size = self._images.shape[0]
         self.log.info('Dataset size: {}'.format(size))
         return size
 
-    def get_batch_idx(self, idx, **kwargs):
-        """Return the next `batch_size` examples from this data set."""
+    def get_batch_idx(self, idx, out=None, **kwargs):
+        """Return the next `batch_size` examples from this data set.
+
+        y_gt holds [N, 10] float32 one-hot labels, or [N] int32 labels with
+        the one_hot option off.
+        """
         if self._images is None:
             self.init_data()
-        if self.split == 'train':
-            return {
-                'x': self._images[VALIDATION_SIZE + numpy.array(idx)],
-                'y_gt': self._labels[VALIDATION_SIZE + numpy.array(idx)]
-            }
-        else:
-            return {
-                'x': self._images[idx],
-                'y_gt': self._labels[idx]
-            }
-        pass
+        return {
+            'x': data_provider.take_batch(self._images, idx, out=out, key='x'),
+            'y_gt': data_provider.get_labels(
+                data_provider.take_batch(self._labels, idx), 10,
+                sparse=not self.get_option('one_hot'), out=out)
+        }
     pass
 
 data_provider.get_factory().register('mnist', MNISTDataProvider)
@@ -0,0 +1,265 @@
+"""
+A bounded cache of decoded samples, with an LRU RAM tier and an optional
+memory-mapped disk tier.
+
+Entries evicted from RAM are spilled to .npy files in the disk folder, and read
+back as memory maps. Entries evicted from disk are deleted. The disk tier only
+lives as long as the cache object: close() deletes the files written by the
+current process, and is called at exit for the caches still open. Forked
+processes skip the atexit handlers, and must call close_all before exiting, as
+the ConcurrentBatchIterator workers do.
+
+Usage:
+    cache = SampleCache(ram_bytes=1 << 30, disk_folder='/tmp/cache')
+    val = cache.get(key)
+    if val is None:
+        val = decode(...)
+        cache.put(key, val)
+    print cache.get_stats()
+    cache.close()
+"""
+from __future__ import division
+
+import atexit
+import collections
+import hashlib
+import numpy as np
+import os
+import threading
+import weakref
+
+from tfplus.utils import logger
+
+# Caches with a disk tier, closed at exit.
+_open_caches = weakref.WeakSet()
+
+
+def close_all():
+    for cache in list(_open_caches):
+        cache.close()
+    pass
+
+atexit.register(close_all)
+
+
+class SampleCache(object):
+
+    def __init__(self, ram_bytes=1 << 30, disk_folder=None,
+                 disk_bytes=16 << 30):
+        """
+        Args:
+            ram_bytes: int, byte budget of the RAM tier.
+            disk_folder: string, folder of the disk tier, or None to disable
+            it.
+            disk_bytes: int, byte budget of the disk tier.
+        """
+        self._ram_bytes = ram_bytes
+        self._disk_folder = disk_folder
+        self._disk_bytes = disk_bytes
+        # Key => (array, meta), least recently used first.
+        self._ram = collections.OrderedDict()
+        self._ram_used = 0
+        # Key => (filename, nbytes, meta), least recently used first.
+        self._disk = collections.OrderedDict()
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self._num_ram_hits = 0
+        self._num_disk_hits = 0
+        self._num_misses = 0
+        self.log = logger.get()
+        if disk_folder is not None:
+            if not os.path.exists(disk_folder):
+                os.makedirs(disk_folder)
+            _open_caches.add(self)
+        pass
+
+    @property
+    def ram_bytes(self):
+        return self._ram_bytes
+
+    @property
+    def disk_folder(self):
+        return self._disk_folder
+
+    @property
+    def disk_bytes(self):
+        return self._disk_bytes
+
+    def get_fname(self, key):
+        return os.path.join(self._disk_folder, '{}-{}.npy'.format(
+            hashlib.sha1(repr(key)).hexdigest(), os.getpid()))
+
+    def get(self, key):
+        """Look up an entry.
+
+        Returns:
+            (array, meta), or None if missing. Arrays from the disk tier are
+            read-only memory maps.
+        """
+        self._lock.acquire()
+        try:
+            if key in self._ram:
+                val = self._ram.pop(key)
+                self._ram[key] = val
+                self._num_ram_hits += 1
+                return val
+            if key in self._disk:
+                entry = self._disk.pop(key)
+                self._disk[key] = entry
+            else:
+                self._num_misses += 1
+                return None
+        finally:
+            self._lock.release()
+        fname, nbytes, meta = entry
+        try:
+            val = np.load(fname, mmap_mode='r'), meta
+        except (IOError, ValueError):
+            # Evicted by another thread in the meantime.
+            val = None
+        self._lock.acquire()
+        try:
+            if val is None:
+                self._num_misses += 1
+            else:
+                self._num_disk_hits += 1
+        finally:
+            self._lock.release()
+        return val
+
+    def put(self, key, array, meta=None):
+        """Add an entry.
+
+        Args:
+            key: hashable.
+            array: numpy array, not to be modified afterwards.
+            meta: small picklable value stored along with the array.
+        """
+        if array.nbytes > self._ram_bytes:
+            self.spill([(key, (array, meta))])
+            return
+        evicted = []
+        self._lock.acquire()
+        try:
+            if key in self._ram:
+                self._ram_used -= self._ram.pop(key)[0].nbytes
+            self._ram[key] = (array, meta)
+            self._ram_used += array.nbytes
+            while self._ram_used > self._ram_bytes:
+                old_key, old_val = self._ram.popitem(last=False)
+                self._ram_used -= old_val[0].nbytes
+                evicted.append((old_key, old_val))
+        finally:
+            self._lock.release()
+        if len(evicted) > 0:
+            self.spill(evicted)
+        pass
+
+    def spill(self, entries):
+        """Move entries to the disk tier, outside of the lock."""
+        if self._disk_folder is None:
+            return
+        written = []
+        for key, (array, meta) in entries:
+            if array.nbytes > self._disk_bytes:
+                continue
+            fname = self.get_fname(key)
+            try:
+                np.save(fname, array)
+            except (IOError, OSError) as e:
+                self.log.warning('Cannot spill to {}: {}'.format(fname, e))
+                continue
+            written.append((key, (fname, array.nbytes, meta)))
+        deleted = []
+        self._lock.acquire()
+        try:
+            for key, entry in written:
+                if key in self._disk:
+                    self._disk_used -= self._disk.pop(key)[1]
+                self._disk[key] = entry
+                self._disk_used += entry[1]
+            while self._disk_used > self._disk_bytes:
+                old_key, old_entry = self._disk.popitem(last=False)
+                self._disk_used -= old_entry[1]
+                deleted.append(old_entry[0])
+        finally:
+            self._lock.release()
+        for fname in deleted:
+            # Another entry may have been spilled to the same file since.
+            if fname not in [entry[0] for key, entry in written]:
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+        pass
+
+    def clear(self):
+        """Drop all entries, and delete the disk tier files."""
+        self._lock.acquire()
+        try:
+            fnames = [entry[0] for entry in self._disk.itervalues()]
+            self._ram.clear()
+            self._disk.clear()
+            self._ram_used = 0
+            self._disk_used = 0
+        finally:
+            self._lock.release()
+        for fname in fnames:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+        pass
+
+    def close(self):
+        """Drop all entries, and delete the disk tier files written by the
+        current process.
+
+        Forked copies of the cache only delete their own files.
+        """
+        suffix = '-{}.npy'.format(os.getpid())
+        self._lock.acquire()
+        try:
+            fnames = [entry[0] for entry in self._disk.itervalues()
+                      if entry[0].endswith(suffix)]
+            self._ram.clear()
+            self._disk.clear()
+            self._ram_used = 0
+            self._disk_used = 0
+        finally:
+            self._lock.release()
+        for fname in fnames:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+        _open_caches.discard(self)
+        pass
+
+    def get_stats(self):
+        """Get the hit counters and the tier usage.
+
+        The counters are only updated under the lock, and read together.
+        """
+        self._lock.acquire()
+        try:
+            num_lookups = self._num_ram_hits + self._num_disk_hits + \
+                self._num_misses
+            if num_lookups > 0:
+                hit_rate = (self._num_ram_hits + self._num_disk_hits) / \
+                    num_lookups
+            else:
+                hit_rate = 0.0
+            return {
+                'ram_hits': self._num_ram_hits,
+                'disk_hits': self._num_disk_hits,
+                'misses': self._num_misses,
+                'hit_rate': hit_rate,
+                'ram_used': self._ram_used,
+                'ram_entries': len(self._ram),
+                'disk_used': self._disk_used,
+                'disk_entries': len(self._disk)
+            }
+        finally:
+            self._lock.release()
+    pass
@@ -1,30 +1,154 @@
+from __future__ import division
+
+import numpy as np
+import threading
+
 from data_provider import DataProvider
 
 
 class SampleDataProvider(DataProvider):
 
-    def __init__(self, data_provider):
+    def __init__(self, data_provider, refill=False, margin=1.2,
+                 max_oversample=100.0, max_tries=100, seed=2):
+        """
+        Args:
+            data_provider: DataProvider to draw the samples from.
+            refill: bool, whether to refill the rejected samples with random
+            candidates, so that batches keep their size. Otherwise, rejected
+            samples are dropped.
+            margin: float, extra candidates drawn in refill mode, on top of
+            the expected number needed given the acceptance rate.
+            max_oversample: float, maximum ratio of candidates to needed
+            samples.
+            max_tries: int, maximum number of reject calls per batch.
+            seed: int, seed of the candidate draws.
+        """
         super(SampleDataProvider, self).__init__()
         self._data_provider = data_provider
+        self._refill = refill
+        self._margin = margin
+        self._max_oversample = max_oversample
+        self._max_tries = max_tries
+        self._rnd = np.random.RandomState(seed)
+        # Exponential moving average of the acceptance rate.
+        self._accept_rate = 1.0
+        self._accept_decay = 0.9
+        self._oversample = margin
+        self._num_candidates = 0
+        self._num_accepted = 0
+        self._num_reject_calls = 0
+        self._num_batches = 0
+        # Producer threads share the statistics.
+        self._mutex = threading.Lock()
         pass
 
     @property
     def data_provider(self):
         return self._data_provider
 
+    @property
+    def indexed(self):
+        return self.data_provider.indexed
+
+    def reseed(self, seed):
+        self._rnd.seed(seed)
+        self.data_provider.reseed(list(seed) + [1])
+        pass
+
+    @property
+    def refill(self):
+        return self._refill
+
     def reject(self, idx):
         """
         Whether to reject a sample.
+
+        Returns:
+            new_idx: the accepted indices, in order.
         """
         raise Exception('Not implemented')
 
     def get_size(self):
         return self.data_provider.get_size()
 
+    def update_accept_rate(self, num_candidates, num_accepted):
+        rate = num_accepted / num_candidates
+        self._mutex.acquire()
+        try:
+            self._accept_rate = self._accept_decay * self._accept_rate + \
+                (1 - self._accept_decay) * rate
+            self._oversample = min(self._max_oversample, self._margin / max(
+                self._accept_rate, 1 / self._max_oversample))
+            self._num_candidates += num_candidates
+            self._num_accepted += num_accepted
+            self._num_reject_calls += 1
+        finally:
+            self._mutex.release()
+        pass
+
+    def refill_idx(self, idx):
+        """Get a full batch of accepted indices.
+
+        The batch indices are topped up with random candidates, as many as the
+        acceptance rate predicts to be needed, so that one reject call usually
+        suffices. The accepted batch indices come first.
+        """
+        num = len(idx)
+        size = self.get_size()
+        cand = np.asarray(idx)
+        num_extra = int(np.ceil(num * (self._oversample - 1)))
+        if num_extra > 0:
+            cand = np.concatenate(
+                [cand, self._rnd.randint(0, size, num_extra)])
+        accepted = []
+        num_accepted = 0
+        for tries in xrange(self._max_tries):
+            # Integer even when reject returns an empty list.
+            acc = np.asarray(self.reject(cand), dtype='int64')
+            self.update_accept_rate(len(cand), len(acc))
+            accepted.append(acc)
+            num_accepted += len(acc)
+            if num_accepted >= num:
+                break
+            num_cand = int(np.ceil((num - num_accepted) * self._oversample))
+            cand = self._rnd.randint(0, size, num_cand)
+        else:
+            raise Exception(
+                'Batch not filled after {} reject calls, acceptance rate '
+                '{:.4f}'.format(self._max_tries, self._accept_rate))
+        self._mutex.acquire()
+        self._num_batches += 1
+        self._mutex.release()
+        return np.concatenate(accepted)[:num]
+
+    def get_stats(self):
+        """Get the acceptance statistics of refill mode."""
+        self._mutex.acquire()
+        try:
+            if self._num_candidates > 0:
+                rate = self._num_accepted / self._num_candidates
+            else:
+                rate = 0.0
+            if self._num_batches > 0:
+                calls_per_batch = self._num_reject_calls / self._num_batches
+            else:
+                calls_per_batch = 0.0
+            return {
+                'accept_rate': rate,
+                'accept_rate_ema': self._accept_rate,
+                'oversample': self._oversample,
+                'reject_calls_per_batch': calls_per_batch
+            }
+        finally:
+            self._mutex.release()
+
     def get_batch_idx(self, idx, **kwargs):
+        if self.refill:
+            return self.data_provider.get_batch_idx(
+                self.refill_idx(idx), **kwargs)
         new_idx = self.reject(idx)
         if len(new_idx) > 0:
             return self.data_provider.get_batch_idx(new_idx, **kwargs)
         else:
-            return self.data_provider.get_batch_idx([new_idx[0]], **kwargs)
+            return self.data_provider.get_batch_idx([idx[0]], **kwargs)
         pass
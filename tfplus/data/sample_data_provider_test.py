@@ -0,0 +1,51 @@
+from __future__ import division
+
+import numpy as np
+import unittest
+
+from tfplus.data import DataProvider, SampleDataProvider
+
+
+class RangeDataProvider(DataProvider):
+
+    def get_size(self):
+        return 1000
+
+    def get_batch_idx(self, idx, **kwargs):
+        return {'x': np.arange(1000)[idx]}
+    pass
+
+
+class ListSampleDataProvider(SampleDataProvider):
+    """Accepts the multiples of 10, as a list."""
+
+    def reject(self, idx):
+        return [ii for ii in idx if ii % 10 == 0]
+    pass
+
+
+class SampleDataProviderTest(unittest.TestCase):
+
+    def test_refill_list_reject(self):
+        """Empty lists from reject still make integer indices."""
+        data = ListSampleDataProvider(RangeDataProvider(), refill=True)
+        for ii in xrange(200):
+            idx = data.refill_idx(np.arange(ii, ii + 8))
+            self.assertEqual(idx.dtype.kind, 'i')
+            self.assertEqual(len(idx), 8)
+            self.assertTrue((idx % 10 == 0).all())
+            self.assertEqual(len(data.get_batch_idx(np.arange(8))['x']), 8)
+        pass
+
+    def test_refill_empty_reject(self):
+        class Empty(SampleDataProvider):
+            def reject(self, idx):
+                return []
+        data = Empty(RangeDataProvider(), refill=True, max_tries=3)
+        self.assertRaises(Exception, data.refill_idx, np.arange(8))
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,314 @@
+"""
+Sequential tar shards of encoded images.
+
+The writer packs (id, encoded image, label) records into large tar files, as
+<id>.jpg and <id>.cls members, along with an index of the shards and their
+record counts. The provider streams the shards sequentially, interleaving a
+few shards at a time and mixing the records through a shuffle buffer, so that
+reading is bound by sequential bandwidth instead of per-file seeks. With
+world_size > 1, each rank streams a disjoint subset of the shards.
+
+Batch indices are ignored, only their count matters: batches are drawn from
+the stream in order, and the stream cycles through the epochs. The shuffle
+buffer carries over epoch boundaries.
+
+Usage:
+    # One-time conversion.
+    python tar_shards.py --split train
+    # Training.
+    data = tfplus.data.create_from_main('tar_shards', split='train')
+"""
+from __future__ import division
+
+import cStringIO
+import cv2
+import numpy as np
+import os
+import tarfile
+import tfplus
+import threading
+import time
+
+from img_preproc import ImagePreprocessor
+
+tfplus.cmd_args.add('tar_shards:folder', 'str', None)
+
+
+def get_index_fname(folder, prefix):
+    return os.path.join(folder, prefix + '_shards.npz')
+
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, cStringIO.StringIO(data))
+    pass
+
+
+def write_shards(records, folder, prefix, shard_size=1000):
+    """Pack records into tar shards.
+
+    Args:
+        records: iterable of (id, encoded image, label), with string ids
+        unique within the prefix, and int labels (-1 if unknown).
+        folder: string, output folder.
+        prefix: string, prefix of the shard filenames.
+        shard_size: int, number of records per shard.
+
+    Returns:
+        names: list of shard filenames.
+    """
+    log = tfplus.utils.logger.get()
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    names = []
+    counts = []
+    tar = None
+    for rec_id, encoded, label in records:
+        if tar is None or counts[-1] == shard_size:
+            if tar is not None:
+                tar.close()
+                log.info('Wrote {} ({:d} records)'.format(
+                    names[-1], counts[-1]))
+            names.append('{}-{:06d}.tar'.format(prefix, len(names)))
+            counts.append(0)
+            tar = tarfile.open(os.path.join(folder, names[-1]), 'w')
+        add_member(tar, rec_id + '.jpg', encoded)
+        add_member(tar, rec_id + '.cls', str(label))
+        counts[-1] += 1
+    if tar is not None:
+        tar.close()
+    np.savez(get_index_fname(folder, prefix), names=np.array(names),
+             counts=np.array(counts, dtype='int64'))
+    log.info('Wrote {:d} records in {:d} shards'.format(
+        int(np.sum(counts)), len(names)))
+    return names
+
+
+def read_shard(fname):
+    """Read the records of a shard, sequentially.
+
+    Yields:
+        (id, encoded image, label)
+    """
+    tar = tarfile.open(fname, 'r|')
+    try:
+        rec_id = None
+        encoded = None
+        for member in tar:
+            key, ext = os.path.splitext(member.name)
+            data = tar.extractfile(member).read()
+            if ext == '.jpg':
+                rec_id = key
+                encoded = data
+            elif ext == '.cls' and key == rec_id:
+                yield rec_id, encoded, int(data)
+                rec_id = None
+    finally:
+        tar.close()
+    pass
+
+
+def imagenet_records(data_provider, order=None):
+    """Get the records of an ImageNetDataProvider split.
+
+    Args:
+        data_provider: ImageNetDataProvider.
+        order: example indices, default all examples in order.
+    """
+    labels = data_provider.labels
+    if order is None:
+        order = xrange(data_provider.get_size())
+    for ii in order:
+        with open(data_provider.get_fname(ii), 'rb') as f:
+            encoded = f.read()
+        if labels is None:
+            label = -1
+        else:
+            label = int(labels[ii])
+        yield '{:08d}'.format(ii), encoded, label
+    pass
+
+
+class TarShardDataProvider(tfplus.data.DataProvider):
+
+    # Batches are drawn from the stream, whatever their indices.
+    indexed = False
+
+    def __init__(self, split='train', folder=None, mode='train',
+                 num_classes=1000, shuffle_buffer=2000, cycle_length=4,
+                 seed=2, rank=0, world_size=1, sparse_labels=False,
+                 preprocessor=None):
+        """
+        Args:
+            split: string, prefix of the shards.
+            folder: string, shard folder.
+            mode: 'train' for random crops, else centre crops.
+            num_classes: int.
+            shuffle_buffer: int, number of records to shuffle across.
+            cycle_length: int, number of shards read in turn.
+            seed: int, seed of the shard order and the shuffle buffer.
+            rank: int, index of this shard subset.
+            world_size: int, number of shard subsets.
+            sparse_labels: bool, see data_provider.get_labels.
+            preprocessor: ImagePreprocessor, default ImageNet style.
+        """
+        super(TarShardDataProvider, self).__init__()
+        if rank < 0 or rank >= world_size:
+            raise Exception('Invalid rank {} for world size {}'.format(
+                rank, world_size))
+        self.log = tfplus.utils.logger.get()
+        self._split = split
+        self._folder = folder
+        self._mode = mode
+        self._num_classes = num_classes
+        self._shuffle_buffer = shuffle_buffer
+        self._cycle_length = cycle_length
+        self._seed = seed
+        self._rank = rank
+        self._world_size = world_size
+        self._sparse_labels = sparse_labels
+        if preprocessor is None:
+            preprocessor = ImagePreprocessor(
+                rnd_hflip=True, rnd_colour=True, rnd_resize=[256, 480],
+                resize=256, crop=224, colour_backend='numpy')
+        self._rnd_proc = preprocessor
+        self._names = None
+        self._counts = None
+        self._stream = None
+        self._mutex = threading.Lock()
+        self.register_option('tar_shards:folder')
+        pass
+
+    @property
+    def folder(self):
+        if self._folder is None:
+            self._folder = self.get_option('tar_shards:folder')
+        return self._folder
+
+    @property
+    def split(self):
+        return self._split
+
+    def reseed(self, seed):
+        # The stream order stays, see indexed.
+        self._rnd_proc.reseed(seed)
+        pass
+
+    def init_index(self):
+        index = np.load(get_index_fname(self.folder, self.split))
+        names = list(index['names'])
+        counts = index['counts']
+        if len(names) < self._world_size:
+            raise Exception('{} shards for world size {}'.format(
+                len(names), self._world_size))
+        # Disjoint shards for each rank.
+        self._counts = counts[self._rank::self._world_size]
+        self._names = names[self._rank::self._world_size]
+        pass
+
+    def get_size(self):
+        if self._names is None:
+            self.init_index()
+        return int(np.sum(self._counts))
+
+    def interleave(self, epoch):
+        """Read the shards of an epoch, cycle_length at a time, one record
+        from each in turn."""
+        random = np.random.RandomState([self._seed, epoch])
+        if self._mode == 'train':
+            order = random.permutation(len(self._names))
+        else:
+            order = np.arange(len(self._names))
+        pending = [os.path.join(self.folder, self._names[ii])
+                   for ii in order]
+        pending.reverse()
+        readers = []
+        while len(readers) > 0 or len(pending) > 0:
+            while len(readers) < self._cycle_length and len(pending) > 0:
+                readers.append(read_shard(pending.pop()))
+            active = []
+            for reader in readers:
+                try:
+                    yield reader.next()
+                    active.append(reader)
+                except StopIteration:
+                    pass
+            readers = active
+        pass
+
+    def record_stream(self):
+        """Endless stream of records, through the shuffle buffer."""
+        if self._names is None:
+            self.init_index()
+        random = np.random.RandomState([self._seed, self._rank])
+        buf = []
+        epoch = 0
+        while True:
+            for record in self.interleave(epoch):
+                if self._mode != 'train' or self._shuffle_buffer <= 1:
+                    yield record
+                elif len(buf) < self._shuffle_buffer:
+                    buf.append(record)
+                else:
+                    kk = random.randint(len(buf))
+                    yield buf[kk]
+                    buf[kk] = record
+            epoch += 1
+        pass
+
+    def next_records(self, num):
+        """Take the next records of the stream, safe across threads."""
+        self._mutex.acquire()
+        try:
+            if self._stream is None:
+                self._stream = self.record_stream()
+            records = [self._stream.next() for ii in xrange(num)]
+        finally:
+            self._mutex.release()
+        return records
+
+    def get_batch_idx(self, idx, out=None, **kwargs):
+        prof = tfplus.utils.profiler.get()
+        with prof.timer('read'):
+            records = self.next_records(len(idx))
+        # Decode outside of the lock.
+        with prof.timer('decode'):
+            images = [cv2.imdecode(np.frombuffer(encoded, dtype='uint8'),
+                                   cv2.IMREAD_COLOR)
+                      for rec_id, encoded, label in records]
+        labels = np.array([label for rec_id, encoded, label in records])
+        dp = tfplus.data.data_provider
+        x = dp.get_output(out, 'x', [len(images), self._rnd_proc.crop,
+                                     self._rnd_proc.crop, 3])
+        return {
+            'x': self._rnd_proc.process_batch(
+                images, rnd=self._mode == 'train', out=x),
+            'y_gt': dp.get_labels(labels, self._num_classes,
+                                  sparse=self._sparse_labels, out=out),
+            'id': [rec_id for rec_id, encoded, label in records]
+        }
+    pass
+
+
+tfplus.data.data_provider.get_factory().register('tar_shards',
+                                                 TarShardDataProvider)
+
+if __name__ == '__main__':
+    from imagenet import ImageNetDataProvider
+    tfplus.init('Pack ImageNet into tar shards')
+    tfplus.cmd_args.add('split', 'str', 'train')
+    tfplus.cmd_args.add('shard_size', 'int', 1000)
+    opt = tfplus.cmd_args.make()
+    data = ImageNetDataProvider(split=opt['split']).init_from_main()
+    folder = opt['tar_shards:folder']
+    if folder is None:
+        folder = os.path.join(data.folder, 'shards')
+    if opt['split'] == 'train':
+        # Shuffle once, so that every shard mixes the classes.
+        order = np.random.RandomState(2).permutation(data.get_size())
+    else:
+        order = None
+    write_shards(imagenet_records(data, order=order), folder, opt['split'],
+                 shard_size=opt['shard_size'])
@@ -18,6 +18,7 @@ from __future__ import division
 
 import os
 import sys
+import threading
 
 from tfplus.utils import cmd_args, Factory, OptionBase, Saver, logger
 from tfplus.utils import time_series_logger as ts_logger
@@ -88,6 +89,28 @@ class EvalExperiment(Experiment):
     pass
 
 
+class RunnerThread(threading.Thread):
+    """Runs one step of a runner in the background."""
+
+    def __init__(self, runner):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.runner = runner
+        self.stop_iteration = False
+        self.exc_info = None
+        pass
+
+    def run(self):
+        try:
+            self.runner.run_step()
+        except StopIteration:
+            self.stop_iteration = True
+        except Exception:
+            self.exc_info = sys.exc_info()
+        pass
+    pass
+
+
 class TrainExperiment(Experiment):
 
     def __init__(self, sess=None, model=None):
@@ -99,8 +122,31 @@ class TrainExperiment(Experiment):
         self._localhost = 'http://localhost'
         self.ts_loggers = {}
         self._preprocessor = lambda x: x
+        self._restore_iters_folder = None
+        self._concurrent = False
+        self._runner_threads = {}
         pass
 
+    @property
+    def concurrent(self):
+        return self._concurrent
+
+    def set_concurrent(self, value):
+        """Run the runners with interval > 1 in background threads, against
+        the shared session and with their own iterators, so that training
+        goes on meanwhile. They still start at their interval and offset, but
+        a start is skipped while the previous run of the runner is going.
+
+        Concurrent runs see live weights: each session run uses the weights
+        of the time, so that a run spanning several batches (e.g. a full
+        validation pass) mixes the weights of several training steps. The
+        results are reported at the training step at which the run started
+        (see EmptyRunner.start_step). Likewise, checkpoints saved by a
+        concurrent saver may mix the weights of consecutive steps.
+        """
+        self._concurrent = value
+        return self
+
     @property
     def logs_folder(self):
         if not os.path.exists(self._logs_folder):
@@ -155,6 +201,63 @@ class TrainExperiment(Experiment):
     def restore_logs(self, logs_folder):
         return self
 
+    def restore_iters_from(self, folder):
+        """Resume the runners' data iteration from the states saved along
+        with the checkpoint in `folder`, see SaverRunner."""
+        self._restore_iters_folder = folder
+        return self
+
+    def restore_iters(self):
+        folder = self._restore_iters_folder
+        if folder is None:
+            return
+        for name, runner in self.runners.iteritems():
+            it = getattr(runner, 'iter', None)
+            if it is None or not hasattr(it, 'restore_state'):
+                continue
+            if os.path.exists(os.path.join(folder, name + '.iter.yaml')):
+                self.log.info('Restoring iterator of runner "{}"'.format(name))
+                it.restore_state(folder, name + '.iter')
+            pass
+        pass
+
+    def start_runner(self, name, runner, step):
+        """Start a run of a runner in the background, unless still running."""
+        thread = self._runner_threads.get(name)
+        if thread is not None and thread.is_alive():
+            self.log.warning(
+                'Runner "{}" still running, skipped at step {}'.format(
+                    name, step))
+            return
+        self.log.info('Runner "{}" started at step {}'.format(name, step))
+        runner.set_start_step(step)
+        thread = RunnerThread(runner)
+        self._runner_threads[name] = thread
+        thread.start()
+        pass
+
+    def check_runners(self, wait=False):
+        """Collect the finished background runs.
+
+        Args:
+            wait: bool, whether to wait for all runs to finish.
+
+        Returns:
+            stop: bool, whether a runner ran out of data.
+        """
+        stop = False
+        for name, thread in self._runner_threads.items():
+            if wait:
+                thread.join()
+            if thread.is_alive():
+                continue
+            del self._runner_threads[name]
+            if thread.exc_info is not None:
+                exc_info = thread.exc_info
+                raise exc_info[0], exc_info[1], exc_info[2]
+            stop = stop or thread.stop_iteration
+        return stop
+
     def run(self):
         default_runner = None
         for runner in self.runners.itervalues():
@@ -162,7 +265,10 @@ class TrainExperiment(Experiment):
                 default_runner = runner
         if default_runner is None:
             raise Exception('Need at least one runner at interval 1.')
-        
+        self.restore_iters()
+        for runner in self.runners.itervalues():
+            runner.prepare()
+
         self.url = os.path.join(self.localhost, 'deep-dashboard') + '?id=' + \
             self.logs_folder.split('/')[-1]
 
@@ -187,6 +293,9 @@ class TrainExperiment(Experiment):
             # Runners
             for name, runner in self.runners.items():
                 if count % runner.interval == 0 and count > runner.offset:
+                    if self.concurrent and runner.interval > 1:
+                        self.start_runner(name, runner, step)
+                        continue
                     if runner.interval > 1:
                         self.log.info('Runner "{}"'.format(name))
                         pass
@@ -196,6 +305,8 @@ class TrainExperiment(Experiment):
                         stop_flag = True
                     pass
                 pass
+            if self.check_runners():
+                stop_flag = True
 
             # Dashboard reminder
             if count % 10 == 0:
@@ -206,6 +317,7 @@ class TrainExperiment(Experiment):
             step = default_runner.step
             pass
 
+        self.check_runners(wait=True)
         for runner in self.runners.itervalues():
             runner.finalize()
             pass
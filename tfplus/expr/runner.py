@@ -1,9 +1,13 @@
 import numpy as np
 import os
+import sys
+import tensorflow as tf
+import threading
 import time
 
 from tfplus.utils import cmd_args, logger, listener, OptionBase, Factory
-from tfplus.utils import plotter
+from tfplus.utils import plotter, profiler
+from tfplus.utils import Accumulator, AsyncListener
 
 cmd_args.add('save_ckpt', 'bool', False)
 
@@ -34,6 +38,12 @@ class EmptyRunner(OptionBase):
         self._interval = 1
         self._offset = 0
         self._experiment = None
+        self._start_step = None
+        pass
+
+    def prepare(self):
+        """Build any extra graph nodes, before the experiment starts
+        running."""
         pass
 
     def run_step(self):
@@ -86,6 +96,19 @@ class EmptyRunner(OptionBase):
     def experiment(self):
         return self._experiment
 
+    def get_start_step(self):
+        return self._start_step
+
+    def set_start_step(self, value):
+        """Set the training step at which a concurrent run started, see
+        TrainExperiment.set_concurrent."""
+        self._start_step = value
+        return self
+
+    @property
+    def start_step(self):
+        return self._start_step
+
 
 class SessionRunner(EmptyRunner):
 
@@ -147,12 +170,24 @@ class SaverRunner(SessionRunner):
         if self.get_option('save_ckpt'):
             self._log.info('Saving checkpoint')
             self.model.save(self.get_session(), step=step)
+            self.save_iter_states()
             pass
         else:
             self._log.warning(
                 'Saving is turned off. Use --save_ckpt flag to save.')
             pass
         pass
+
+    def save_iter_states(self):
+        """Save the iteration state of the other runners next to the
+        checkpoint, so that data iteration resumes mid-epoch."""
+        if self.experiment is None:
+            return
+        for name, runner in self.experiment.runners.iteritems():
+            it = getattr(runner, 'iter', None)
+            if it is not None and hasattr(it, 'save_state'):
+                it.save_state(self.model.folder, name + '.iter')
+        pass
     pass
 
 get_factory().register('saver', SaverRunner)
@@ -183,6 +218,89 @@ class RestorerRunner(SessionRunner):
 get_factory().register('restorer', RestorerRunner)
 
 
+class ProfileRunner(SessionRunner):
+    """Writes the data pipeline profile, see tfplus.utils.profiler.
+
+    Adding the runner turns the profiler on. Every run writes the stage
+    statistics since the previous run.
+    """
+
+    def __init__(self, folder=None):
+        super(ProfileRunner, self).__init__()
+        self.folder = folder
+        self._step = 0
+        profiler.get().enable()
+        pass
+
+    def set_folder(self, value):
+        self.folder = value
+        return self
+
+    def run_step(self):
+        if self.model is not None and self.model.has_var('step'):
+            step = self.get_session().run(self.model.get_var('step'))
+            self._step = int(step)
+        else:
+            self._step += self.interval
+        folder = self.folder
+        if folder is None:
+            folder = self.experiment.logs_folder
+        profiler.get().flush(folder, self._step)
+        pass
+    pass
+
+get_factory().register('profile', ProfileRunner)
+
+
+class InputEnqueuer(threading.Thread):
+    """Feeds the batches of a runner into the model input queue.
+
+    The queue is closed once the iterator ends, or the thread fails. In the
+    latter case, the error is kept in exc_info, for the consumer to re-raise
+    instead of ending the iteration.
+    """
+
+    def __init__(self, runner):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.runner = runner
+        self.stopped = False
+        self.exc_info = None
+        pass
+
+    def run(self):
+        runner = self.runner
+        queue = runner.model.input_queue
+        sess = runner.session
+        try:
+            while not self.stopped:
+                try:
+                    inp = runner.iter.next()
+                except StopIteration:
+                    break
+                feed_dict = {}
+                inp_ = runner.preprocessor(inp)
+                for key, var in queue['inputs'].iteritems():
+                    feed_dict[var] = inp_[key]
+                sess.run(queue['enqueue'], feed_dict=feed_dict)
+                # The queue holds a copy of the batch.
+                runner.release(inp)
+        except tf.errors.CancelledError:
+            pass
+        except Exception as e:
+            runner.log.error('Input enqueue thread failed: {}'.format(e))
+            self.exc_info = sys.exc_info()
+        finally:
+            # Also wakes up a consumer blocked on the failed thread.
+            if not self.stopped:
+                try:
+                    sess.run(queue['close'])
+                except tf.errors.CancelledError:
+                    pass
+        pass
+    pass
+
+
 class BasicRunner(SessionRunner):
 
     def __init__(self):
@@ -195,45 +313,84 @@ class BasicRunner(SessionRunner):
         self._log = logger.get()
         self._preprocessor = lambda x: x
         self._listeners = []
+        self._input_queue = False
+        self._enqueuer = None
+        self._fetch_plan = None
         pass
 
+    @property
+    def input_queue(self):
+        return self._input_queue
+
+    def set_input_queue(self, value):
+        """Feed the batches through the model input queue (see
+        Model.set_input_queue), from a background thread, so that host to
+        device transfers overlap with compute. Only one runner per model may
+        use the queue. phase_train is still fed at every step.
+
+        In this mode, the results only hold the outputs, not the batch.
+        """
+        self._input_queue = value
+        return self
+
     @property
     def listeners(self):
         return self._listeners
 
-    def write_log(self, results):
-        for listener in self.listeners:
-            listener.listen(results)
-            pass
+    def write_log(self, results, done=None):
+        """Hand the results to the listeners.
+
+        Args:
+            results: dict, not to be modified afterwards.
+            done: function called once no listener uses the results anymore,
+            see listener.dispatch.
+        """
+        listener.dispatch(self.listeners, results, done=done)
+        pass
 
-    def add_listener(self, listener):
+    def add_listener(self, listener, policy=None, queue_size=4):
+        """Add a listener.
+
+        Args:
+            listener: Listener.
+            policy: None to run the listener on the runner thread, else the
+            queue policy of an AsyncListener, 'drop_oldest', 'coalesce' or
+            'block'.
+            queue_size: int, queue size of an AsyncListener.
+        """
+        if policy is not None:
+            listener = AsyncListener(listener=listener, policy=policy,
+                                     queue_size=queue_size)
         self.listeners.append(listener)
         return self
 
-    def add_csv_listener(self, name, var_name, label=None):
-        self.listeners.append(listener.get_factory().create(
-            'csv', name=name, var_name=var_name, label=label))
-        # if var_name not in self.outputs:
-        # self.outputs.append(var_name)
-        return self
+    def add_csv_listener(self, name, var_name, label=None, policy='block'):
+        return self.add_listener(listener.get_factory().create(
+            'csv', name=name, var_name=var_name, label=label), policy=policy)
 
-    def add_plot_listener(self, name, mapping):
-        self.listeners.append(listener.AdapterListener(
-            mapping=mapping,
-            listener=plotter.get(name)))
-        # for var_name in mapping.iterkeys():
-        #     if var_name not in self.outputs:
-        #         self.outputs.append(var_name)
-        return self
+    def add_plot_listener(self, name, mapping, policy='coalesce'):
+        return self.add_listener(listener.AdapterListener(
+            mapping=mapping, listener=plotter.get(name)), policy=policy)
 
-    def add_cmd_listener(self, name, var_name):
-        self.listeners.append(listener.get_factory().create(
-            'cmd', name=name, var_name=var_name))
-        # if var_name not in self.outputs:
-        #     self.outputs.append(var_name)
-        return self
+    def add_cmd_listener(self, name, var_name, policy=None):
+        return self.add_listener(listener.get_factory().create(
+            'cmd', name=name, var_name=var_name), policy=policy)
+
+    def flush_listeners(self):
+        """Wait for the asynchronous listeners."""
+        for ll in self.listeners:
+            if isinstance(ll, AsyncListener):
+                ll.flush()
+        pass
 
     def finalize(self):
+        if self._enqueuer is not None:
+            self._enqueuer.stopped = True
+            self.session.run(self.model.input_queue['cancel'])
+            self._enqueuer = None
+        if hasattr(self.iter, 'finalize'):
+            self.iter.finalize()
+        self.flush_listeners()
         pass
 
     @property
@@ -293,13 +450,19 @@ class BasicRunner(SessionRunner):
     def current_batch(self):
         return self._current_batch
 
+    @property
+    def report_step(self):
+        """Step of the results, the start step of concurrent runs."""
+        if self.start_step is not None:
+            return self.start_step
+        return self.step
+
     def _run_step(self, inp):
         """Train step"""
         self._current_batch = inp
         bat_sz_total = 0
         results = {}
 
-        feed_dict = self.get_feed_dict(inp)
         start_time = time.time()
         r = self.run_model(inp)
         step_time = (time.time() - start_time) * 1000
@@ -309,37 +472,77 @@ class BasicRunner(SessionRunner):
             self._step = int(r['step'])
         return r
 
+    def get_fetch_plan(self):
+        """Get the fetches and feeds of a step. The plan is compiled once, and
+        only rebuilt when the model or the outputs change.
+
+        Returns:
+            plan: dict, with fetches, the output tensors, names, the result
+            keys, inputs, (name, input variable) pairs, and phase_train, the
+            phase_train input variable or None.
+        """
+        key = (self.model, tuple(self.outputs))
+        if self._fetch_plan is None or self._fetch_plan['key'] != key:
+            names = [r for r in self.outputs if r != 'step_time']
+            if self.model.has_var('step'):
+                names.append('step')
+            if self.model.has_var('phase_train'):
+                phase_train = self.model.get_input_var('phase_train')
+            else:
+                phase_train = None
+            self._fetch_plan = {
+                'key': key,
+                'fetches': [self.model.get_var(r) for r in names],
+                'names': names,
+                'inputs': self.model.get_all_input_vars().items(),
+                'phase_train': phase_train
+            }
+        return self._fetch_plan
+
     def get_feed_dict(self, inp):
+        plan = self.get_fetch_plan()
         inp = self._preprocessor(inp)
         feed_dict = {}
-        if self.model.has_var('phase_train'):
-            feed_dict[self.model.get_input_var(
-                'phase_train')] = self.phase_train
-
-        for key in inp.iterkeys():
-            if self.model.has_input_var(key):
-                feed_dict[self.model.get_input_var(key)] = inp[key]
-                pass
+        if plan['phase_train'] is not None:
+            feed_dict[plan['phase_train']] = self.phase_train
+        for key, var in plan['inputs']:
+            if key in inp:
+                feed_dict[var] = inp[key]
         return feed_dict
 
     def run_model(self, inp):
-        feed_dict = self.get_feed_dict(inp)
-        symbol_list = []
-        output_list = []
-        for r in self.outputs:
-            if r != 'step_time':
-                symbol_list.append(self.model.get_var(r))
-                output_list.append(r)
-        if self.model.has_var('step'):
-            symbol_list.append(self.model.get_var('step'))
-            output_list.append('step')
-        results = self.session.run(symbol_list, feed_dict=feed_dict)
-        results_dict = {}
-        for rr, name in zip(results, output_list):
-            results_dict[name] = rr
-        return results_dict
+        prof = profiler.get()
+        with prof.timer('feed'):
+            feed_dict = self.get_feed_dict(inp)
+        plan = self.get_fetch_plan()
+        with prof.timer('session_run'):
+            results = self.session.run(plan['fetches'], feed_dict=feed_dict)
+        return dict(zip(plan['names'], results))
+
+    def run_step_queue(self):
+        """Run a step on a batch from the input queue."""
+        if self.model.input_queue is None:
+            raise Exception('Model "{}" has no input queue'.format(
+                self.model.name))
+        if self._enqueuer is None:
+            self._enqueuer = InputEnqueuer(self)
+            self._enqueuer.start()
+        try:
+            results = self._run_step({})
+        except tf.errors.OutOfRangeError:
+            exc_info = self._enqueuer.exc_info
+            if exc_info is not None:
+                # The data pipeline failed, the data did not run out.
+                raise exc_info[0], exc_info[1], exc_info[2]
+            raise StopIteration
+        if self.start_step is not None:
+            results['step'] = self.start_step
+        self.write_log(results)
+        return True
 
     def run_step(self):
+        if self.input_queue:
+            return self.run_step_queue()
         inp = self.iter.next()
 
         if len(self.outputs) > 0:
@@ -350,10 +553,19 @@ class BasicRunner(SessionRunner):
         for key in inp.iterkeys():
             if key not in results:
                 results[key] = inp[key]
+        if self.start_step is not None:
+            results['step'] = self.start_step
 
-        self.write_log(results)
+        # The batch goes back to the iterator once the listeners are done.
+        self.write_log(results, done=lambda: self.release(inp))
         return True
 
+    def release(self, inp):
+        """Hand the batch back to the iterator, once fully consumed."""
+        if hasattr(self.iter, 'release'):
+            self.iter.release(inp)
+        pass
+
     pass
 
 get_factory().register('basic', BasicRunner)
@@ -364,6 +576,90 @@ class AverageRunner(BasicRunner):
     def __init__(self):
         super(AverageRunner, self).__init__()
         self._num_batch = 1
+        self._streaming = False
+        self._stream = None
+        self._stream_names = None
+        pass
+
+    @property
+    def streaming(self):
+        return self._streaming
+
+    def get_streaming(self):
+        return self._streaming
+
+    def set_streaming(self, value):
+        """Average the outputs in the graph (see
+        Model.build_streaming_average). Every batch only runs the update op,
+        and the averages are fetched once per run. The outputs need static
+        shapes. step_time is timed on the host, as the time of the update
+        step, averaged over the examples."""
+        self._streaming = value
+        return self
+
+    def prepare(self):
+        if self.streaming:
+            self.get_stream()
+        pass
+
+    def get_stream(self):
+        names = [r for r in self.outputs if r not in ['step', 'step_time']]
+        stream = self.model.build_streaming_average(names, scope=self.name)
+        if stream is not self._stream:
+            self.session.run(stream['reset'])
+            self._stream = stream
+            self._stream_names = names
+        return stream
+
+    def run_step_streaming(self):
+        stream = self.get_stream()
+        prof = profiler.get()
+        stop_flag = False
+        step_time_total = 0.0
+        bat_sz_total = 0
+
+        # Accumulate each batch in the graph.
+        for bb in xrange(self.num_batch):
+            try:
+                inp = self.iter.next()
+            except StopIteration:
+                stop_flag = True
+                break
+            start_time = time.time()
+            bat_sz = inp[inp.keys()[0]].shape[0]
+            with prof.timer('feed'):
+                feed_dict = self.get_feed_dict(inp)
+            feed_dict[stream['weight']] = bat_sz
+            with prof.timer('session_run'):
+                self.session.run(stream['update'], feed_dict=feed_dict)
+            step_time_total += (time.time() - start_time) * 1000 * bat_sz
+            bat_sz_total += bat_sz
+            self.release(inp)
+            pass
+
+        # Fetch the averages, and reset the sums.
+        fetches = [stream['count']] + stream['sums']
+        if self.model.has_var('step'):
+            fetches.append(self.model.get_var('step'))
+        values = self.session.run(fetches)
+        self.session.run(stream['reset'])
+        if self.model.has_var('step'):
+            self._step = int(values.pop())
+        count = values[0]
+        results = {}
+        if count > 0:
+            for key, value in zip(self._stream_names, values[1:]):
+                results[key] = value / count
+                pass
+        if 'step_time' in self.outputs and bat_sz_total > 0:
+            results['step_time'] = step_time_total / bat_sz_total
+
+        # Do not average steps.
+        results['step'] = self.report_step
+        self.write_log(results)
+
+        if stop_flag:
+            raise StopIteration
         pass
 
     @property
@@ -378,6 +674,8 @@ class AverageRunner(BasicRunner):
         return self
 
     def run_step(self):
+        if self.streaming:
+            return self.run_step_streaming()
         bat_sz_total = 0
         results = {}
 
@@ -401,6 +699,7 @@ class AverageRunner(BasicRunner):
                 break
             _results = self._run_step(inp)
             bat_sz = inp[inp.keys()[0]].shape[0]
+            self.release(inp)
             bat_sz_total += bat_sz
             for key in _results.iterkeys():
                 if _results[key] is not None:
@@ -416,7 +715,7 @@ class AverageRunner(BasicRunner):
             pass
 
         # Do not average steps.
-        results['step'] = self.step
+        results['step'] = self.report_step
         self.write_log(results)
 
         if stop_flag:
@@ -427,10 +726,17 @@ get_factory().register('average', AverageRunner)
 
 
 class AccumulateRunner(BasicRunner):
+    """Collects the outputs of num_batch batches, stacked as [num_batch, ...],
+    or concatenated along the first axis with set_concat, see
+    tfplus.utils.accumulator. Past max_bytes, the outputs spill to .npy files
+    in the logs folder, and the listeners get read-only memory maps."""
 
     def __init__(self):
         super(AccumulateRunner, self).__init__()
         self._num_batch = 1
+        self._concat = False
+        self._max_bytes = 1 << 30
+        self._spill_folder = None
         pass
 
     @property
@@ -444,46 +750,86 @@ class AccumulateRunner(BasicRunner):
         self._num_batch = value
         return self
 
-    def run_step(self):
-        bat_sz_total = 0
-        results = {}
+    @property
+    def concat(self):
+        return self._concat
 
+    def get_concat(self):
+        return self._concat
+
+    def set_concat(self, value):
+        """Concatenate the batch outputs along the first axis (scalars are
+        stacked), instead of stacking them. Allows a smaller last batch."""
+        self._concat = value
+        return self
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def get_max_bytes(self):
+        return self._max_bytes
+
+    def set_max_bytes(self, value):
+        self._max_bytes = value
+        return self
+
+    @property
+    def spill_folder(self):
+        if self._spill_folder is None and self.experiment is not None:
+            return self.experiment.logs_folder
+        return self._spill_folder
+
+    def get_spill_folder(self):
+        return self._spill_folder
+
+    def set_spill_folder(self, value):
+        self._spill_folder = value
+        return self
+
+    def run_step(self):
         # Initialize values.
         if len(self.outputs) == 0:
             self.log.warning(
                 'Empty outputs list for runner "{}"'.format(self.name))
-        for key in self.outputs:
-            results[key] = []
-            pass
-        results['step_time'] = []
+        acc = Accumulator(folder=self.spill_folder, max_bytes=self.max_bytes,
+                          prefix=self.name)
 
         stop_flag = False
 
-        # Run each batch.
-        for bb in xrange(self.num_batch):
-            try:
-                # inp = self.data_provider.get_batch()
-                inp = self.iter.next()
-            except StopIteration:
-                stop_flag = True
-                break
-            _results = self._run_step(inp)
-            for key in _results.iterkeys():
-                if _results[key] is not None:
-                    if key not in results:
-                        results[key] = []
-                    results[key].append(_results[key])
+        try:
+            # Run each batch.
+            for bb in xrange(self.num_batch):
+                try:
+                    # inp = self.data_provider.get_batch()
+                    inp = self.iter.next()
+                except StopIteration:
+                    stop_flag = True
+                    break
+                _results = self._run_step(inp)
+                self.release(inp)
+                for key in _results.iterkeys():
+                    if key == 'step' or _results[key] is None:
+                        continue
+                    value = _results[key]
+                    if not self.concat:
+                        value = np.expand_dims(value, 0)
+                    acc.append(key, value)
+                    pass
                 pass
-            pass
 
-        # Concatenate all batches.
-        for key in results.iterkeys():
-            results[key] = np.array(results[key])
-            print key, results[key].shape
+            # Concatenate all batches.
+            results = acc.finalize()
+        finally:
+            # Delete the spill files of a failed run, none once finalized.
+            acc.discard()
+        for key in self.outputs:
+            if key not in results:
+                results[key] = np.zeros([0])
             pass
 
         # Do not average steps.
-        results['step'] = self.step
+        results['step'] = self.report_step
         self.write_log(results)
 
         if stop_flag:
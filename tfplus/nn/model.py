@@ -58,6 +58,9 @@ class Model(GraphBuilder, OptionBase):
         self._has_built_all = False
         self._folder = None
         self._global_step = None
+        self._input_queue_capacity = 0
+        self._input_queue = None
+        self._streaming_averages = {}
         pass
 
     @property
@@ -283,6 +286,131 @@ class Model(GraphBuilder, OptionBase):
         """Add a loss."""
         tf.add_to_collection('losses', var)
 
+    @property
+    def input_queue(self):
+        """Input queue, or None.
+
+        Returns:
+            input_queue: dict with the placeholders to feed the enqueue op
+            ('inputs'), and the 'enqueue', 'close', 'cancel' and 'size' ops.
+        """
+        return self._input_queue
+
+    def set_input_queue(self, capacity):
+        """Feed the inputs through an in-graph FIFO queue of batches.
+
+        Call before building the graph. The input variables then default to a
+        dequeue of the queue, but can still be fed directly, so that runners
+        that feed the inputs work unchanged. phase_train is never queued.
+
+        Args:
+            capacity: int, number of batches in the queue, 0 for no queue.
+        """
+        if self.has_built_all:
+            raise Exception('Cannot set the input queue after building')
+        self._input_queue_capacity = capacity
+        return self
+
+    def build_input_queue(self, inp_var):
+        """Wire the input variables to a dequeue op.
+
+        Args:
+            inp_var: dict, returned by build_input.
+
+        Returns:
+            inp_var: dict, with the queued inputs replaced.
+        """
+        if self._input_queue_capacity == 0 or type(inp_var) != dict:
+            return inp_var
+        names = []
+        for name in sorted(inp_var.iterkeys()):
+            if name != 'phase_train' and self.has_input_var(name) and \
+                    inp_var[name] is self.get_input_var(name):
+                names.append(name)
+        placeholders = [inp_var[name] for name in names]
+        with tf.device('/cpu:0'):
+            queue = tf.FIFOQueue(self._input_queue_capacity,
+                                 [pp.dtype for pp in placeholders],
+                                 name='input_queue')
+            enqueue = queue.enqueue(placeholders)
+            close = queue.close()
+            cancel = queue.close(cancel_pending_enqueues=True)
+            size = queue.size()
+            dequeue = queue.dequeue()
+        if len(names) == 1:
+            dequeue = [dequeue]
+        inp_var = dict(inp_var)
+        for name, pp, dd in zip(names, placeholders, dequeue):
+            dd.set_shape(pp.get_shape())
+            var = tf.placeholder_with_default(dd, pp.get_shape(),
+                                              name=name + '_dequeue')
+            self._inp_var_dict[name] = var
+            self._var_dict[name] = var
+            inp_var[name] = var
+        self._input_queue = {
+            'inputs': dict(zip(names, placeholders)),
+            'enqueue': enqueue,
+            'close': close,
+            'cancel': cancel,
+            'size': size
+        }
+        return inp_var
+
+    def build_streaming_average(self, names, scope='stream'):
+        """Build in-graph sums of outputs across batches, weighted by the batch
+        sizes, so that the outputs are averaged without being fetched at
+        every batch. Built once per list of names.
+
+        The sums are kept out of the variable collections, and so out of
+        initialization and checkpoints. Run the reset op before the first
+        update.
+
+        Args:
+            names: list of output variable names, with static shapes.
+            scope: string, name of the sums, distinct for each runner that
+            may run concurrently.
+
+        Returns:
+            stream: dict with the batch size placeholder to feed with every
+            update ('weight'), the 'update' and 'reset' ops, the sum variables
+            in the order of the names ('sums'), and the total weight
+            ('count').
+        """
+        key = (scope, tuple(names))
+        if key in self._streaming_averages:
+            return self._streaming_averages[key]
+        with tf.device('/cpu:0'), tf.name_scope(scope):
+            weight = tf.placeholder('float64', [], name='weight')
+            count = tf.Variable(tf.zeros([], dtype='float64'),
+                                trainable=False, collections=[],
+                                name='count')
+            updates = [tf.assign_add(count, weight)]
+            resets = [tf.assign(count, tf.zeros([], dtype='float64'))]
+            sums = []
+            for name in names:
+                var = self.get_var(name)
+                shape = var.get_shape()
+                if not shape.is_fully_defined():
+                    raise Exception(
+                        'Output "{}" has no static shape to stream'.format(
+                            name))
+                zeros = tf.zeros(shape.as_list(), dtype='float64')
+                sum_var = tf.Variable(zeros, trainable=False, collections=[],
+                                      name=name + '_sum')
+                updates.append(tf.assign_add(
+                    sum_var, tf.to_double(var) * weight))
+                resets.append(tf.assign(sum_var, zeros))
+                sums.append(sum_var)
+        stream = {
+            'weight': weight,
+            'update': tf.group(*updates),
+            'reset': tf.group(*resets),
+            'sums': sums,
+            'count': count
+        }
+        self._streaming_averages[key] = stream
+        return stream
+
     def build_input(self):
         """Build input nodes. To be implemented by subclasses.
 
@@ -325,7 +453,7 @@ class Model(GraphBuilder, OptionBase):
         self._has_built_all = True
         with tf.device(self.get_device_fn()):
             with tf.variable_scope(self.name):
-                inp_var = self.build_input()
+                inp_var = self.build_input_queue(self.build_input())
                 output_var = self.build(inp_var)
         return self
 
@@ -336,7 +464,7 @@ class Model(GraphBuilder, OptionBase):
         self._has_built_all = True
         with tf.device(self.get_device_fn()):
             with tf.variable_scope(self.name):
-                inp_var = self.build_input()
+                inp_var = self.build_input_queue(self.build_input())
                 output_var = self.build(inp_var)
                 gs = self.global_step
                 loss_var = self.build_loss(inp_var, output_var)
@@ -349,7 +477,7 @@ class Model(GraphBuilder, OptionBase):
         self._has_built_all = True
         with tf.device(self.get_device_fn()):
             with tf.variable_scope(self.name):
-                inp_var = self.build_input()
+                inp_var = self.build_input_queue(self.build_input())
                 output_var = self.build(inp_var)
                 loss_var = self.build_loss(inp_var, output_var)
                 train_step = self.build_optim(loss_var)
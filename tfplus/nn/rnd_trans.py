@@ -9,6 +9,17 @@ import tensorflow as tf
 
 
 class ImageRandomTransform(GraphBuilder):
+    """Random crop, flip and transpose, drawn for each example.
+
+    In training, all transformations are applied at once, by gathering the
+    source pixel of every output pixel. In evaluation, the images are cropped
+    at offset 0, like the unpadded corner of the padded images. A conditional
+    on phase_train picks the branch, so that only one of them runs.
+
+    Random transposition keeps the image shape, and so needs square images:
+    build raises if the static height and width differ, and the graph asserts
+    it otherwise.
+    """
 
     def __init__(self, padding=0, rnd_vflip=True, rnd_hflip=True,
                  rnd_transpose=True, rnd_size=False, shrink=0,
@@ -23,26 +34,147 @@ class ImageRandomTransform(GraphBuilder):
         self._debug = _debug
         pass
 
-    def init_var(self):
-        self.rand_h = tf.random_uniform([1], 1.0 - float(self.rnd_hflip), 1.0)
-        self.rand_v = tf.random_uniform([1], 1.0 - float(self.rnd_vflip), 1.0)
-        self.rand_t = tf.random_uniform(
-            [1], 1.0 - float(self.rnd_transpose), 1.0)
-        self.offset = tf.random_uniform(
-            [2], dtype='int32', maxval=self.padding * 2 + self.shrink)
+    def draw_flag(self, num, enabled):
+        """Draw a 0/1 flag for each example, 1 with probability 0.5."""
+        if not enabled:
+            return tf.zeros(tf.pack([num]), dtype='int32')
+        return tf.to_int32(tf.random_uniform(tf.pack([num])) < 0.5)
+
+    def draw_int(self, num, low, high):
+        """Draw an integer in [low, high) for each example, low if the range
+        is empty."""
+        rnd = tf.random_uniform(tf.pack([num]))
+        return tf.to_int32(tf.floor(rnd * tf.to_float(
+            tf.maximum(high - low, 0)))) + low
+
+    def draw_params(self, num):
+        """Draw the random parameters of each example.
+
+        Args:
+            num: batch size.
+
+        Returns:
+            params: dict of [num] int32, offset_y and offset_x, crop offsets
+            within the padded images, delta_y and delta_x, crop size changes
+            (rnd_size only), flip_v, flip_h and transpose, 0/1 flags.
+        """
+        span = self.padding * 2 + self.shrink
+        params = {
+            'offset_y': self.draw_int(num, 0, span),
+            'offset_x': self.draw_int(num, 0, span),
+            'flip_v': self.draw_flag(num, self.rnd_vflip),
+            'flip_h': self.draw_flag(num, self.rnd_hflip),
+            'transpose': self.draw_flag(num, self.rnd_transpose)
+        }
+        if self.rnd_size:
+            # No room left when the offset exceeds the padding, with shrink.
+            space_y = tf.maximum(2 * self.padding - params['offset_y'], 0)
+            space_x = tf.maximum(2 * self.padding - params['offset_x'], 0)
+            params['delta_y'] = self.draw_int(num, -space_y, space_y)
+            params['delta_x'] = self.draw_int(num, -space_x, space_x)
         if self._debug:
-            self.offset = tf.Print(self.offset,
-                                   ['Forward RND module', self.offset])
+            params['offset_y'] = tf.Print(
+                params['offset_y'], ['Forward RND module',
+                                     params['offset_y'], params['offset_x']])
+        return params
+
+    def get_source_coords(self, params, inp_height, inp_width):
+        """Get the source coordinates of the output pixels, within the padded
+        images.
+
+        Returns:
+            yy: [N, H, W] int32 rows.
+            xx: [N, H, W] int32 columns.
+        """
+        def per_example(v):
+            return tf.reshape(v, [-1, 1, 1])
+
+        rows = tf.reshape(tf.range(0, inp_height), [1, -1, 1])
+        cols = tf.reshape(tf.range(0, inp_width), [1, 1, -1])
+        # Transpose.
+        tr = per_example(params['transpose'])
+        yy = rows * (1 - tr) + cols * tr
+        xx = cols * (1 - tr) + rows * tr
+        # Flip.
+        flip_v = per_example(params['flip_v'])
+        flip_h = per_example(params['flip_h'])
+        yy += flip_v * (inp_height - 1 - 2 * yy)
+        xx += flip_h * (inp_width - 1 - 2 * xx)
+        # Nearest neighbour resize of the crop.
         if self.rnd_size:
-            self.space = 2 * self.padding - self.offset
-            self.offset20 = tf.random_uniform(
-                [], dtype='int32', maxval=self.space[0] * 2) - self.space[0]
-            self.offset21 = tf.random_uniform(
-                [], dtype='int32', maxval=self.space[1] * 2) - self.space[1]
-            self.offset2 = tf.pack([self.offset20, self.offset21])
+            yy = tf.div(yy * per_example(inp_height + params['delta_y']),
+                        inp_height)
+            xx = tf.div(xx * per_example(inp_width + params['delta_x']),
+                        inp_width)
+        # Crop.
+        yy += per_example(params['offset_y'])
+        xx += per_example(params['offset_x'])
+        return yy, xx
+
+    def build_random(self, x, axis):
+        """Randomly transform each example, with one gather."""
+        padding = self.padding
+        xshape = tf.shape(x)
+        num = xshape[0]
+        if axis == 3:
+            height = xshape[1]
+            width = xshape[2]
+            pad = [[0, 0], [padding, padding], [padding, padding], [0, 0]]
         else:
-            self.offset2 = tf.zeros([2], dtype='int32')
-        pass
+            height = xshape[2]
+            width = xshape[3]
+            pad = [[0, 0], [0, 0], [padding, padding], [padding, padding]]
+        if self.rnd_transpose:
+            check = tf.Assert(tf.equal(height, width), [
+                'Random transposition needs square images', height, width])
+            with tf.control_dependencies([check]):
+                num = tf.identity(num)
+        if padding > 0:
+            x = tf.pad(x, pad)
+        pad_height = height + 2 * padding
+        pad_width = width + 2 * padding
+        yy, xx = self.get_source_coords(
+            self.draw_params(num), height - self.shrink, width - self.shrink)
+        batch = tf.reshape(tf.range(0, num), [-1, 1, 1])
+        if axis == 3:
+            # Gather pixels, [N * H' * W', C] => [N, H, W, C].
+            flat = (batch * pad_height + yy) * pad_width + xx
+            x = tf.reshape(x, tf.pack([-1, xshape[3]]))
+        else:
+            # Gather values, [N * C * H' * W'] => [N, C, H, W].
+            chan = tf.reshape(tf.range(0, xshape[1]), [1, -1, 1, 1])
+            batch = tf.expand_dims(batch, 1)
+            yy = tf.expand_dims(yy, 1)
+            xx = tf.expand_dims(xx, 1)
+            flat = ((batch * xshape[1] + chan) * pad_height + yy) * \
+                pad_width + xx
+            x = tf.reshape(x, [-1])
+        # Model.get_device_fn pins Gather to the CPU, for embedding lookups.
+        # Clear the device functions, and keep the gather next to the batch,
+        # so that the batch does not round trip through host memory.
+        with tf.device(None):
+            with tf.device(x.device):
+                return tf.gather(x, flat)
+
+    def build_eval(self, x, axis):
+        """Evaluation crop, at offset 0."""
+        if self.shrink == 0:
+            return x
+        xshape = tf.shape(x)
+        if axis == 3:
+            return tf.slice(x, [0, 0, 0, 0], tf.pack(
+                [-1, xshape[1] - self.shrink, xshape[2] - self.shrink, -1]))
+        else:
+            return tf.slice(x, [0, 0, 0, 0], tf.pack(
+                [-1, -1, xshape[2] - self.shrink, xshape[3] - self.shrink]))
+
+    def get_output_shape(self, x, axis):
+        """Static output shape, the input shape less the shrinkage."""
+        shape = x.get_shape().as_list()
+        for dim in [1, 2] if axis == 3 else [2, 3]:
+            if shape[dim] is not None:
+                shape[dim] -= self.shrink
+        return shape
 
     def build(self, inp):
         self.lazy_init_var()
@@ -56,91 +188,36 @@ class ImageRandomTransform(GraphBuilder):
             axis = inp['axis']
         else:
             axis = 3
-
-        padding = self.padding
-        offset = self.offset
-        offset2 = self.offset2
-        rand_h = self.rand_h
-        rand_v = self.rand_v
-        rand_t = self.rand_t
-
-        xshape = tf.shape(x)
-        phase_train_f = tf.to_float(phase_train)
-
-        if axis == 3:
-            inp_height = xshape[1] - self.shrink
-            inp_width = xshape[2] - self.shrink
-            # Add padding
-            if self.padding > 0:
-                x_rand = tf.pad(
-                    x, [[0, 0], [padding, padding], [padding, padding],
-                        [0, 0]])
-                x_ctr = tf.slice(x_rand, [0, padding, padding, 0],
-                                 tf.pack([-1, inp_height, inp_width, -1]))
+        if self.rnd_transpose:
+            shape = x.get_shape().as_list()
+            hh, ww = shape[1: 3] if axis == 3 else shape[2: 4]
+            if hh is not None and ww is not None and hh != ww:
+                raise Exception(
+                    'Random transposition needs square images, got {}x{}'
+                    .format(hh, ww))
+
+        def train_fn():
+            x_rand = self.build_random(x, axis)
+            if rnd_colour:
+                x_rand = random_hue(x_rand, 32. / 255.)
+                x_rand = random_saturation(x_rand, 0.5, 1.5)
+                x_rand = tf.image.random_brightness(x_rand, 0.2)
+                x_rand = tf.image.random_contrast(x_rand, 0.5, 1.5)
+                x_rand = tf.clip_by_value(x_rand, 0.0, 1.0)
+            return x_rand
+
+        def eval_fn():
+            return self.build_eval(x, axis)
+
+        if isinstance(phase_train, bool):
+            if phase_train:
+                y = train_fn()
             else:
-                x_ctr = x
-                x_rand = x
-
-            if self.padding != 0 or self.shrink != 0:
-                # Random crop
-                x_rand = tf.slice(x_rand, tf.pack([0, offset[0], offset[1], 0]),
-                                  tf.pack([-1, inp_height + offset2[0],
-                                           inp_width + offset2[1], -1]))
-                if self.rnd_size:
-                    x_rand = tf.image.resize_nearest_neighbor(
-                        x_rand, tf.pack([inp_height, inp_width]))
-
-            if self.rnd_hflip or self.rnd_vflip:
-                mirror = tf.pack([1.0, rand_v[0], rand_h[0], 1.0]) < 0.5
-                x_rand = tf.reverse(x_rand, mirror)
-
-            if self.rnd_transpose:
-                do_tr = tf.cast(rand_t[0] < 0.5, 'int32')
-                x_rand = tf.transpose(x_rand, tf.pack(
-                    [0, 1 + do_tr, 2 - do_tr, 3]))
-
-        elif axis == 1:
-            inp_height = xshape[2]
-            inp_width = xshape[3]
-
-            if self.padding > 0:
-                x_rand = tf.pad(
-                    x, [[0, 0], [0, 0], [padding, padding],
-                        [padding, padding]])
-                x_ctr = tf.slice(x_rand, [0, 0, padding, padding],
-                                 tf.pack([-1, -1, inp_height, inp_width]))
-            else:
-                x_ctr = x
-                x_rand = x
-
-            if self.padding != 0 or self.shrink != 0:
-                x_rand = tf.slice(x_rand, tf.pack([0, 0, offset[0], offset[1]]),
-                                  tf.pack([-1, -1, inp_height + offset2[0],
-                                           inp_width + offset2[1]]))
-                if self.rnd_size:
-                    x_rand = tf.transpose(x_rand, [0, 2, 3, 1])
-                    x_rand = tf.image.resize_nearest_neighbor(
-                        x_rand, tf.pack([inp_height, inp_width]))
-                    x_rand = tf.transpose(x_rand, [0, 3, 1, 2])
-
-            if self.rnd_hflip or self.rnd_vflip:
-                mirror = tf.pack([1.0, 1.0, rand_v[0], rand_h[0]]) < 0.5
-                x_rand = tf.reverse(x_rand, mirror)
-
-            if self.rnd_transpose:
-                do_tr = tf.cast(rand_t[0] < 0.5, 'int32')
-                x_rand = tf.transpose(x_rand, tf.pack(
-                    [0, 1, 2 + do_tr, 3 - do_tr]))
-
-        if rnd_colour:
-            x_rand = random_hue(x_rand, 32. / 255.)
-            x_rand = random_saturation(x_rand, 0.5, 1.5)
-            x_rand = tf.image.random_brightness(x_rand, 0.2)
-            x_rand = tf.image.random_contrast(x_rand, 0.5, 1.5)
-            x_rand = tf.clip_by_value(x_rand, 0.0, 1.0)
-
-        x = (1.0 - phase_train_f) * x_ctr + phase_train_f * x_rand
-        return x
+                y = eval_fn()
+        else:
+            y = tf.cond(phase_train, train_fn, eval_fn)
+        y.set_shape(self.get_output_shape(x, axis))
+        return y
     pass
 
 
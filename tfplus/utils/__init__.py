@@ -2,13 +2,15 @@ from factory import Factory
 from option_base import OptionBase
 from saver import Saver
 from option_saver import OptionSaver
+from sampler import ShardedSampler, BucketSampler
 from batch_iter import IBatchIterator, BatchIterator
 from concurrent_batch_iter import ConcurrentBatchIterator
 from grad_clip_optim import GradientClipOptimizer
-from listener import Listener, AdapterListener
+from listener import Listener, AdapterListener, AsyncListener
 from csv_listener import CSVListener
 from cmd_listener import CmdListener
 from plotter import Plotter, ThumbnailPlotter
 from confusion_plotter import ConfusionMatrixPlotter
 from video_plotter import VideoPlotter
 from log_manager import LogManager
+from accumulator import Accumulator
@@ -0,0 +1,218 @@
+"""
+Growable buffers of batch outputs, concatenated along the first axis.
+
+Each key is written into one contiguous buffer, which doubles its capacity as
+needed. Once the buffers in RAM exceed the byte budget, the growing buffer is
+moved to a memory-mapped .npy file in the spill folder. When finalized, the
+spilled files are trimmed to their contents and reopened read-only, so that
+readers get views instead of copies. Buffers in RAM are returned as views too,
+unless less than half full, in which case they are copied to release the spare
+capacity. discard() deletes the spill files of an unfinished accumulation.
+
+Scalars are stacked, one row each.
+
+Usage:
+    acc = Accumulator(folder=logs_folder, max_bytes=1 << 30, prefix='valid')
+    try:
+        for batch in batches:
+            acc.append('feat', batch['feat'])
+        results = acc.finalize()
+    finally:
+        # Nothing left to delete once finalized.
+        acc.discard()
+"""
+from __future__ import division
+
+import numpy as np
+import os
+
+import logger
+
+
+def trim_npy(fname, num):
+    """Trim a .npy file of rows to its first num rows, in place.
+
+    The header keeps its length, padded with spaces, so that the data does not
+    move.
+    """
+    with open(fname, 'rb+') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            len_bytes = 2
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            len_bytes = 4
+        offset = f.tell()
+        new_shape = (num,) + tuple(shape[1:])
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': fortran, 'shape': new_shape})
+        # Same length as the old header, ending with a newline.
+        header_len = offset - 8 - len_bytes
+        header = header.ljust(header_len - 1) + '\n'
+        f.seek(8 + len_bytes)
+        f.write(header)
+        row_bytes = dtype.itemsize * int(np.prod(shape[1:]))
+        f.truncate(offset + num * row_bytes)
+    pass
+
+
+class Accumulator(object):
+
+    def __init__(self, folder=None, max_bytes=1 << 30, prefix='acc'):
+        """
+        Args:
+            folder: string, spill folder, or None to keep everything in RAM.
+            max_bytes: int, byte budget of the buffers in RAM.
+            prefix: string, prefix of the spill filenames.
+        """
+        self._folder = folder
+        self._max_bytes = max_bytes
+        self._prefix = prefix
+        # Key => buffer, number of rows, spill filename or None.
+        self._bufs = {}
+        self._sizes = {}
+        self._fnames = {}
+        self.log = logger.get()
+        pass
+
+    @property
+    def folder(self):
+        return self._folder
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def get_ram_bytes(self):
+        """Bytes of the buffers in RAM."""
+        return sum([buf.nbytes for key, buf in self._bufs.iteritems()
+                    if self._fnames[key] is None])
+
+    def get_fname(self, key, tmp=False):
+        name = '{}_{}.npy'.format(self._prefix, key.replace(os.sep, '_'))
+        if tmp:
+            name += '.tmp-{}'.format(os.getpid())
+        return os.path.join(self._folder, name)
+
+    def alloc(self, key, shape, dtype):
+        """Allocate a buffer, on disk if over the RAM budget."""
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self._folder is not None and (
+                self._fnames.get(key) is not None or
+                self.get_ram_bytes() + nbytes > self._max_bytes):
+            fname = self.get_fname(key, tmp=True)
+            if self._fnames.get(key) is None:
+                self.log.info('Spilling "{}" to {}'.format(key, fname))
+            if not os.path.exists(self._folder):
+                os.makedirs(self._folder)
+            # A new file, so that the old buffer stays readable while copied.
+            new_fname = fname + '.new'
+            buf = np.lib.format.open_memmap(new_fname, mode='w+',
+                                            dtype=dtype, shape=tuple(shape))
+            return buf, new_fname
+        return np.empty(shape, dtype=dtype), None
+
+    def grow(self, key, num):
+        """Make room for num more rows."""
+        buf = self._bufs[key]
+        size = self._sizes[key]
+        if size + num <= buf.shape[0]:
+            return
+        shape = [max(buf.shape[0] * 2, size + num)] + list(buf.shape[1:])
+        new_buf, new_fname = self.alloc(key, shape, buf.dtype)
+        new_buf[:size] = buf[:size]
+        self.install(key, new_buf, new_fname)
+        pass
+
+    def install(self, key, buf, new_fname):
+        """Make a buffer the current one of a key."""
+        self._bufs[key] = buf
+        if new_fname is not None:
+            fname = self.get_fname(key, tmp=True)
+            os.rename(new_fname, fname)
+            self._fnames[key] = fname
+        else:
+            self._fnames[key] = None
+        pass
+
+    def append(self, key, value):
+        """Append a batch of rows, or a scalar as one row.
+
+        Args:
+            key: string.
+            value: [N, ...] array, with the same trailing shape at every call.
+        """
+        value = np.asarray(value)
+        if value.ndim == 0:
+            value = value.reshape([1])
+        num = value.shape[0]
+        if key not in self._bufs:
+            shape = [max(num, 1)] + list(value.shape[1:])
+            buf, new_fname = self.alloc(key, shape, value.dtype)
+            self.install(key, buf, new_fname)
+            self._sizes[key] = 0
+        buf = self._bufs[key]
+        if buf.shape[1:] != value.shape[1:]:
+            raise Exception('Shape mismatch for "{}": {} vs {}'.format(
+                key, buf.shape[1:], value.shape[1:]))
+        self.grow(key, num)
+        size = self._sizes[key]
+        self._bufs[key][size: size + num] = value
+        self._sizes[key] = size + num
+        pass
+
+    def get(self, key):
+        """Get a view of the rows so far."""
+        return self._bufs[key][:self._sizes[key]]
+
+    def keys(self):
+        return self._bufs.keys()
+
+    def finalize(self):
+        """Get the rows of all keys, and reset the accumulator.
+
+        Buffers in RAM less than half full are copied out, others returned
+        as views. Spilled buffers are trimmed and renamed to
+        <prefix>_<key>.npy, then memory-mapped read-only.
+
+        Returns:
+            results: dict, key => array.
+        """
+        results = {}
+        for key in self._bufs.iterkeys():
+            fname = self._fnames[key]
+            if fname is None:
+                if self._sizes[key] < self._bufs[key].shape[0] / 2:
+                    results[key] = self.get(key).copy()
+                else:
+                    results[key] = self.get(key)
+                continue
+            self._bufs[key].flush()
+            self._bufs[key] = None
+            trim_npy(fname, self._sizes[key])
+            # Renamed over any previous file, so that its readers keep the
+            # old contents.
+            final_fname = self.get_fname(key)
+            os.rename(fname, final_fname)
+            results[key] = np.load(final_fname, mmap_mode='r')
+        self._bufs = {}
+        self._sizes = {}
+        self._fnames = {}
+        return results
+
+    def discard(self):
+        """Drop all rows, and delete the spill files, including those of a
+        spill cut short."""
+        if self._folder is not None:
+            for key in self._bufs.keys():
+                self._bufs[key] = None
+                fname = self.get_fname(key, tmp=True)
+                for ff in [fname, fname + '.new']:
+                    if os.path.exists(ff):
+                        os.remove(ff)
+        self._bufs = {}
+        self._sizes = {}
+        self._fnames = {}
+        pass
+    pass
@@ -9,11 +9,17 @@ Usage:
 """
 from __future__ import division
 
+import itertools
 import numpy as np
 import progress_bar as pb
 import logger
+import profiler
+import Queue
 import threading
 
+from option_saver import OptionSaver
+from sampler import ShardedSampler
+
 
 class IBatchIterator(object):
 
@@ -23,12 +29,45 @@ class IBatchIterator(object):
 
     def next(self):
         raise Exception('Not implemented')
+
+    def release(self, batch):
+        """Signal that the consumer is done with a batch."""
+        pass
+
+    def finalize(self):
+        """Stop any helper threads."""
+        pass
+    pass
+
+
+class ProgressReporter(threading.Thread):
+    """Reports the progress of a batch iterator, off the iteration path."""
+
+    def __init__(self, batch_iter):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.q = Queue.Queue()
+        self.batch_iter = batch_iter
+
+    def run(self):
+        while True:
+            step = self.q.get()
+            if step is None:
+                break
+            self.batch_iter.print_progress(step)
+        pass
+
+    def stop(self):
+        """Print the pending reports, then exit."""
+        self.q.put(None)
+        self.join()
+        pass
     pass
 
 
 class BatchIterator(IBatchIterator):
 
-    def __init__(self, num, batch_size=1, progress_bar=False, log_epoch=10, get_fn=None, cycle=False, shuffle=True, stagnant=False):
+    def __init__(self, num, batch_size=1, progress_bar=False, log_epoch=10, get_fn=None, cycle=False, shuffle=True, stagnant=False, seed=2, rank=0, world_size=1, sampler=None):
         """Construct a batch iterator.
 
         Args:
@@ -36,10 +75,25 @@ class BatchIterator(IBatchIterator):
             feature dimension.
             labels: numpy.ndarray, (N), N is the number of examples.
             batch_size: int, batch size.
+            seed: int, seed of the per-epoch permutations.
+            rank: int, index of the shard to iterate.
+            world_size: int, number of shards, see ShardedSampler.
+            sampler: ShardedSampler to draw the indices from, e.g. a
+            BucketSampler built with the same batch size. Overrides num,
+            shuffle, seed, rank and world_size.
         """
 
-        self._num = num
+        if sampler is None:
+            # Only cycling iterators are shuffled.
+            sampler = ShardedSampler(
+                num, seed=seed, shuffle=shuffle and cycle, rank=rank,
+                world_size=world_size)
+        self._sampler = sampler
+        self._num = self._sampler.shard_size
         self._batch_size = batch_size
+        # Atomic step counter, next() on itertools.count holds the GIL.
+        self._counter = itertools.count()
+        # Highest step claimed + 1, see step.
         self._step = 0
         self._num_steps = int(np.ceil(self._num / float(batch_size)))
         self._pb = None
@@ -47,18 +101,14 @@ class BatchIterator(IBatchIterator):
         self._get_fn = get_fn
         self.get_fn = get_fn
         self._cycle = cycle
-        self._shuffle_idx = np.arange(self._num)
-        self._shuffle = shuffle
-        self._random = np.random.RandomState(2)
-        self._shuffle_flag = shuffle
         self._stagnant = stagnant
         self._log_epoch = log_epoch
         self._log = logger.get()
-        self._epoch = 0
         if progress_bar:
             self._pb = pb.get(self._num_steps)
             pass
-        self._mutex = threading.Lock()
+        self._reporter = None
+        self._reporter_lock = threading.Lock()
         pass
 
     def __iter__(self):
@@ -73,20 +123,119 @@ class BatchIterator(IBatchIterator):
     def variables(self):
         return self._variables
 
+    @property
+    def sampler(self):
+        return self._sampler
+
+    @property
+    def data_provider(self):
+        """Provider whose get_batch_idx is the get_fn, or None."""
+        return getattr(self._get_fn, 'im_self', None)
+
+    def reseed(self, seed):
+        """Reseed np.random and the random states of the data provider (see
+        DataProvider.reseed). The sampler keeps its seed, so that the batch
+        indices stay the same.
+
+        Args:
+            seed: list of int.
+        """
+        np.random.seed(seed)
+        if hasattr(self.data_provider, 'reseed'):
+            self.data_provider.reseed(seed)
+        pass
+
+    @property
+    def step(self):
+        """Number of batches handed out.
+
+        Exact with a single consumer. While several threads call next, it
+        may lag behind the claimed steps by up to the number of threads.
+        """
+        step = self._step
+        if not self._cycle:
+            step = min(step, self._num_steps)
+        return step
+
+    @property
+    def epoch(self):
+        return int(self.step * self._batch_size / self._num)
+
     def set_variables(self, variables):
         self._variables = variables
 
-        def get_fn(idx):
-            return self._get_fn(idx, variables=variables)
+        def get_fn(idx, **kwargs):
+            return self._get_fn(idx, variables=variables, **kwargs)
         self.get_fn = get_fn
         return self
 
     def reset(self):
+        self._counter = itertools.count()
         self._step = 0
 
-    def print_progress(self):
-        e = self._epoch
-        a = (self._step * self._batch_size) % self._num
+    def get_state(self, step=None):
+        """Get the iteration state, to resume from later.
+
+        Args:
+            step: int, number of batches consumed, default step. Iterators
+            that prefetch batches pass the number actually consumed.
+        """
+        if step is None:
+            step = self.step
+        return {
+            'position': step * self._batch_size,
+            'sampler': self._sampler.get_state()
+        }
+
+    def set_state(self, state):
+        """Resume from a state returned by get_state."""
+        self._sampler.set_state(state['sampler'])
+        self._step = int(state['position'] / self._batch_size)
+        self._counter = itertools.count(self._step)
+        return self
+
+    def save_state(self, folder, name):
+        OptionSaver(folder, name).save(self.get_state())
+        pass
+
+    def restore_state(self, folder, name):
+        return self.set_state(OptionSaver(folder, name).read())
+
+    def report(self, step):
+        """Hand a progress report over to the reporter thread."""
+        if self._reporter is None:
+            self._reporter_lock.acquire()
+            try:
+                if self._reporter is None:
+                    reporter = ProgressReporter(self)
+                    reporter.start()
+                    self._reporter = reporter
+            finally:
+                self._reporter_lock.release()
+        self._reporter.q.put(step)
+        pass
+
+    def finalize(self):
+        """Stop the reporter thread, after its pending reports."""
+        self._reporter_lock.acquire()
+        try:
+            if self._reporter is not None:
+                self._reporter.stop()
+                self._reporter = None
+        finally:
+            self._reporter_lock.release()
+        pass
+
+    def print_progress(self, step=None):
+        if step is None:
+            step = self.step
+        if self._pb is not None:
+            while self._pb.value < min(step, self._num_steps):
+                self._pb.increment()
+        if self._log_epoch <= 0 or step % self._log_epoch != 0:
+            return
+        e = int(step * self._batch_size / self._num)
+        a = (step * self._batch_size) % self._num
         b = self._num
         p = a / b * 100
         digit = int(np.ceil(np.log10(b)))
@@ -98,66 +247,43 @@ class BatchIterator(IBatchIterator):
 
     def next(self):
         """Iterate next element."""
-        self._mutex.acquire()
-        try:
-            # Shuffle data.
-            if self._shuffle_flag:
-                self._random.shuffle(self._shuffle_idx)
-                self._shuffle_flag = False
-
-            # Read/write of self._step stay in a thread-safe block.
-            if not self._cycle:
-                if self._step >= self._num_steps:
-                    raise StopIteration()
-
-            # Calc start/end based on current step.
-            start = self._batch_size * self._step
-            end = self._batch_size * (self._step + 1)
-
-            # Progress bar.
-            if self._pb is not None:
-                self._pb.increment()
+        idx = self.next_idx()
+        if self.get_fn is not None:
+            with profiler.get().timer('get_batch'):
+                return self.get_fn(idx)
+        else:
+            return idx
 
-            # Epoch record.
-            if self._cycle:
-                if int(end / self._num) > int(start / self._num):
-                    self._epoch += 1
+    def next_idx(self):
+        """Iterate next batch of indices, without calling get_fn.
 
-            # Increment step.
-            if not self._stagnant:
-                self._step += 1
+        Lock-free: each call claims a distinct step from the counter, and the
+        indices are sliced out of the sampler's epoch permutations.
+        """
+        if self._stagnant:
+            step = self.step
+        else:
+            step = next(self._counter)
+            # Racy, but only ever lags behind, see step.
+            if step >= self._step:
+                self._step = step + 1
+        if not self._cycle:
+            if step >= self._num_steps:
+                raise StopIteration()
 
-            # Print progress
-            if self._log_epoch > 0 and self._step % self._log_epoch == 0:
-                self.print_progress()
-        finally:
-            self._mutex.release()
+        # Calc start/end based on current step.
+        start = self._batch_size * step
+        end = self._batch_size * (step + 1)
 
+        # Progress bar and progress log.
+        if not self._stagnant:
+            if self._pb is not None or \
+                    (self._log_epoch > 0 and (step + 1) % self._log_epoch == 0):
+                self.report(step + 1)
 
         if not self._cycle:
             end = min(self._num, end)
-            idx = np.arange(start, end)
-            if self.get_fn is not None:
-                return self.get_fn(idx)
-            else:
-                return idx
-        else:
-            start = start % self._num
-            end = end % self._num
-            if end > start:
-                idx = np.arange(start, end)
-                idx = self._shuffle_idx[idx]
-            else:
-                idx = np.array(range(start, self._num) + range(0, end))
-                idx = self._shuffle_idx[idx]
-                # Shuffle every cycle.
-                if self._shuffle:
-                    self._shuffle_flag = True
-            if self.get_fn is not None:
-                return self.get_fn(idx)
-            else:
-                return idx
-        pass
+        return self._sampler.get_indices(start, end)
 
 if __name__ == '__main__':
     for ii in BatchIterator(400, batch_size=32, progress_bar=True,
@@ -0,0 +1,214 @@
+"""
+A fixed-capacity ring of preallocated batch slots.
+
+Each numpy array in a batch gets a fixed region in every slot, sized after an
+example batch. Producers copy batches into free slots, and consumers read them
+back as zero-copy views, which are released once consumed. With shared=True,
+the slots live in shared memory, so that batches can cross process boundaries
+without pickling the arrays.
+
+Usage:
+    ring = BatchRing(example_batch, num_slots=10)
+    # Producer, with a token unique among the producers.
+    q.put(ring.write(batch, token))
+    # Or, let the producer fill the slot in place.
+    slot, out = ring.reserve(token)
+    q.put(ring.commit(slot, get_batch(out=out)))
+    # Consumer.
+    batch = ring.read(q.get())
+    sess.run(..., feed_dict={x: batch['x']})
+    ring.release(batch)
+"""
+from __future__ import division
+
+import multiprocessing
+import numpy as np
+import Queue
+
+# Align each array to a cache line.
+kAlign = 64
+
+
+def _align(nbytes):
+    return int(np.ceil(nbytes / kAlign)) * kAlign
+
+
+class RingBatch(dict):
+    """A batch dict whose arrays are views into a ring slot."""
+
+    def __init__(self, slot, *args, **kwargs):
+        super(RingBatch, self).__init__(*args, **kwargs)
+        self.slot = slot
+        pass
+    pass
+
+
+class BatchRing(object):
+
+    def __init__(self, example, num_slots=10, shared=False):
+        """Allocate the slots for batches shaped like `example`.
+
+        With shared=True, must be constructed before forking the producer
+        processes.
+
+        Args:
+            example: dict, an example batch. Other values than numpy arrays
+            (and arrays that outgrow their region) are passed along with the
+            slot descriptor.
+            num_slots: int, number of batches that can be in flight.
+            shared: bool, whether to allocate the slots in shared memory.
+        """
+        self._layout = {}
+        slot_bytes = 0
+        for key in sorted(example.iterkeys()):
+            val = example[key]
+            if isinstance(val, np.ndarray):
+                self._layout[key] = (slot_bytes, val.nbytes, val.shape,
+                                     val.dtype)
+                slot_bytes += _align(val.nbytes)
+        self._slot_bytes = max(slot_bytes, kAlign)
+        self._num_slots = num_slots
+        self._shared = shared
+        if shared:
+            self._buf = multiprocessing.RawArray(
+                'b', self._slot_bytes * num_slots)
+            self._mem = np.frombuffer(self._buf, dtype='uint8')
+            # Token of the producer writing to the slot, 0 if none.
+            self._owner = np.frombuffer(
+                multiprocessing.RawArray('l', num_slots), dtype='int64')
+            self._free = multiprocessing.Queue()
+        else:
+            self._mem = np.empty([self._slot_bytes * num_slots], dtype='uint8')
+            self._owner = np.zeros([num_slots], dtype='int64')
+            self._free = Queue.Queue()
+        for ii in xrange(num_slots):
+            self._free.put(ii)
+        pass
+
+    @property
+    def num_slots(self):
+        return self._num_slots
+
+    @property
+    def slot_bytes(self):
+        return self._slot_bytes
+
+    @property
+    def shared(self):
+        return self._shared
+
+    def get_view(self, slot, key, shape, dtype):
+        """Get a view of the region of `key` in a slot."""
+        dtype = np.dtype(dtype)
+        start = slot * self._slot_bytes + self._layout[key][0]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self._mem[start: start + nbytes].view(dtype).reshape(shape)
+
+    def fits(self, key, val):
+        return key in self._layout and isinstance(val, np.ndarray) and \
+            val.nbytes <= self._layout[key][1]
+
+    def reserve(self, owner):
+        """Take a free slot, to be filled in place. Blocks until a slot is
+        free.
+
+        Args:
+            owner: int > 0, token of the producer, unique among the producers
+            (not a thread or process ID, which can be reused), see reclaim.
+
+        Returns:
+            slot: int, slot index, to pass to commit.
+            out: dict, views of the slot regions, shaped like the example
+            batch.
+        """
+        slot = self._free.get()
+        self._owner[slot] = owner
+        out = {}
+        for key, (start, nbytes, shape, dtype) in self._layout.iteritems():
+            out[key] = self.get_view(slot, key, shape, dtype)
+        return slot, out
+
+    def write(self, batch, owner):
+        """Copy a batch into a free slot. Blocks until a slot is free.
+
+        Args:
+            owner: int > 0, token of the producer, see reserve.
+
+        Returns:
+            desc: dict, small picklable slot descriptor.
+        """
+        return self.commit(self.reserve(owner)[0], batch)
+
+    def commit(self, slot, batch):
+        """Publish a batch in a reserved slot.
+
+        Arrays already written in place in the slot are not copied.
+
+        Returns:
+            desc: dict, small picklable slot descriptor.
+        """
+        arrays = {}
+        extra = {}
+        for key, val in batch.iteritems():
+            if self.fits(key, val):
+                view = self.get_view(slot, key, val.shape, val.dtype)
+                if val.ctypes.data != view.ctypes.data:
+                    view[...] = val
+                arrays[key] = (val.shape, val.dtype.str)
+            else:
+                extra[key] = val
+        # Hand over the ownership before the descriptor becomes visible, so
+        # that a dead producer can never cause a double release.
+        self._owner[slot] = 0
+        return {'slot': slot, 'arrays': arrays, 'extra': extra}
+
+    def read(self, desc, copy=False):
+        """Read a batch from its slot.
+
+        Args:
+            desc: slot descriptor returned by write.
+            copy: bool, if True, copy the arrays out and release the slot
+            right away. Otherwise the arrays are views into the slot, valid
+            until the batch is released.
+        """
+        slot = desc['slot']
+        batch = RingBatch(slot, desc['extra'])
+        for key, (shape, dtype) in desc['arrays'].iteritems():
+            batch[key] = self.get_view(slot, key, shape, dtype)
+        if copy:
+            for key in desc['arrays'].iterkeys():
+                batch[key] = batch[key].copy()
+            self.release(slot)
+            batch = dict(batch)
+        return batch
+
+    def release(self, batch):
+        """Give a slot back to the producers.
+
+        Args:
+            batch: RingBatch, or slot index.
+        """
+        if isinstance(batch, RingBatch):
+            slot = batch.slot
+        else:
+            slot = batch
+        self._owner[slot] = 0
+        self._free.put(slot)
+        pass
+
+    def reclaim(self, owner):
+        """Release the slots held by a dead producer.
+
+        Args:
+            owner: int, token of the producer.
+
+        Returns:
+            count: int, number of slots reclaimed.
+        """
+        count = 0
+        for ii in xrange(self._num_slots):
+            if self._owner[ii] == owner:
+                self.release(ii)
+                count += 1
+        return count
+    pass
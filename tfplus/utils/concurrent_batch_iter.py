@@ -1,68 +1,533 @@
 from __future__ import division
 
+import multiprocessing
+import os
 import Queue
+import sys
 import threading
 import tfplus
+import time
+
+import profiler
 
 from batch_iter import IBatchIterator, BatchIterator
+from batch_ring import BatchRing, RingBatch
+from option_saver import OptionSaver
+
+
+def fill_slot(ring, get_fn, idx, owner):
+    """Build a batch straight into a ring slot.
+
+    Returns:
+        desc: slot descriptor.
+    """
+    slot, out = ring.reserve(owner)
+    return ring.commit(slot, get_fn(idx, out=out))
+
+
+class ResizableQueue(Queue.Queue):
+    """A queue whose maximum size can change while in use."""
+
+    def put(self, item, block=True, timeout=None):
+        if not block or timeout is not None:
+            return Queue.Queue.put(self, item, block=block, timeout=timeout)
+        self.not_full.acquire()
+        try:
+            # The size may exceed a maxsize that just shrank.
+            while self.maxsize > 0 and self._qsize() >= self.maxsize:
+                self.not_full.wait()
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        finally:
+            self.not_full.release()
+        pass
+
+    def resize(self, maxsize):
+        self.mutex.acquire()
+        try:
+            self.maxsize = maxsize
+            self.not_full.notify_all()
+        finally:
+            self.mutex.release()
+        pass
+    pass
 
 
 class BatchProducer(threading.Thread):
 
-    def __init__(self, q, batch_iter):
+    def __init__(self, q, batch_iter, ring=None, in_place=False, index=0):
         threading.Thread.__init__(self)
         self.q = q
         self.batch_iter = batch_iter
+        self.ring = ring
+        self.in_place = in_place
+        # Owner of the ring slots being written, unique within the pool.
+        self.token = index + 1
+        # Set to retire the producer after its current batch.
+        self.stopped = False
+        # Whether the producer exited normally, as opposed to crashed.
+        self.finished = False
+
+    def run(self):
+        while not self.stopped:
+            try:
+                if self.in_place:
+                    batch = fill_slot(self.ring, self.batch_iter.get_fn,
+                                      self.batch_iter.next_idx(), self.token)
+                else:
+                    batch = self.batch_iter.next()
+                    if self.ring is not None:
+                        batch = self.ring.write(batch, self.token)
+                with profiler.get().timer('queue_put'):
+                    self.q.put(batch)
+            except StopIteration:
+                self.q.put(None)
+                break
+        self.finished = True
+        pass
+    pass
+
+
+class IndexProducer(threading.Thread):
+    """Feeds batch indices to the worker processes."""
+
+    def __init__(self, task_q, batch_iter, num_workers):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.task_q = task_q
+        self.batch_iter = batch_iter
+        self.num_workers = num_workers
 
     def run(self):
         while True:
             try:
-                self.q.put(self.batch_iter.next())
+                self.task_q.put(self.batch_iter.next_idx())
             except StopIteration:
+                for ii in xrange(self.num_workers):
+                    self.task_q.put(None)
+                break
+        pass
+    pass
+
+
+class WorkerBase(object):
+    """Builds the batches of the indices in the task queue, into shared
+    memory slots. Parked while its active event is cleared."""
+
+    def __init__(self, task_q, q, batch_iter, ring, in_place=False,
+                 index=0, active=None):
+        self.task_q = task_q
+        self.q = q
+        self.batch_iter = batch_iter
+        self.ring = ring
+        self.in_place = in_place
+        # Worker index, to seed the random draws.
+        self.index = index
+        # Owner of the ring slots being written, unique within the pool.
+        self.token = index + 1
+        if active is None:
+            active = multiprocessing.Event()
+            active.set()
+        self.active = active
+        # Whether the worker exited normally, as opposed to crashed.
+        self.finished = False
+
+    def work(self):
+        while True:
+            # Parked workers do not take tasks.
+            self.active.wait()
+            idx = self.task_q.get()
+            if idx is None:
                 self.q.put(None)
                 break
+            if self.in_place:
+                self.q.put(fill_slot(self.ring, self.batch_iter.get_fn, idx,
+                                     self.token))
+            else:
+                self.q.put(self.ring.write(self.batch_iter.get_fn(idx),
+                                           self.token))
+        self.finished = True
         pass
     pass
 
 
+class BatchWorker(WorkerBase, multiprocessing.Process):
+    """A worker process. Only forked when the pool starts."""
+
+    def __init__(self, *args, **kwargs):
+        multiprocessing.Process.__init__(self)
+        WorkerBase.__init__(self, *args, **kwargs)
+        self.daemon = True
+
+    def run(self):
+        # Forked workers inherit the random states of the parent, reseed them
+        # so that every worker draws differently.
+        self.batch_iter.reseed([os.getpid(), self.index])
+        try:
+            self.work()
+        finally:
+            # Worker processes exit without running the atexit handlers,
+            # delete the cache files they spilled. No caches exist unless
+            # the module was loaded.
+            sample_cache = sys.modules.get('tfplus.data.sample_cache')
+            if sample_cache is not None:
+                sample_cache.close_all()
+        pass
+
+    @property
+    def crashed(self):
+        return not self.is_alive() and self.exitcode != 0
+    pass
+
+
+class WorkerThread(WorkerBase, threading.Thread):
+    """A worker thread, replacing a crashed worker process without forking
+    after startup."""
+
+    def __init__(self, *args, **kwargs):
+        threading.Thread.__init__(self)
+        WorkerBase.__init__(self, *args, **kwargs)
+        self.daemon = True
+
+    def run(self):
+        self.work()
+        pass
+
+    @property
+    def crashed(self):
+        return not self.is_alive() and not self.finished
+    pass
+
+
+class ProducerPoolTuner(object):
+    """Sizes a producer pool from the consumer wait time and the queue
+    occupancy.
+
+    The pool grows while the consumer waits for batches, first in producers,
+    then in queue size. It shrinks while the consumer never waits and the
+    queue stays nearly full, first in producers, then in queue size.
+    """
+
+    def __init__(self, num_threads_range, queue_size_range, interval=50,
+                 starve_ratio=0.05, idle_ratio=0.01, full_ratio=0.75):
+        """
+        Args:
+            num_threads_range: (min, max) number of producers.
+            queue_size_range: (min, max) queue size.
+            interval: int, number of batches between decisions.
+            starve_ratio: float, fraction of the consumer time spent waiting
+            above which the pool grows.
+            idle_ratio: float, fraction of the consumer time spent waiting
+            below which the pool may shrink.
+            full_ratio: float, mean queue occupancy, relative to its size,
+            above which the pool may shrink.
+        """
+        self.num_threads_range = num_threads_range
+        self.queue_size_range = queue_size_range
+        self.interval = interval
+        self.starve_ratio = starve_ratio
+        self.idle_ratio = idle_ratio
+        self.full_ratio = full_ratio
+        self.reset()
+        pass
+
+    def reset(self):
+        self._count = 0
+        self._wait = 0.0
+        self._total = 0.0
+        self._occupancy = 0
+        pass
+
+    def record(self, wait, total, occupancy):
+        """Record a batch.
+
+        Args:
+            wait: float, time the consumer waited for the batch.
+            total: float, time since the previous batch.
+            occupancy: int, queue size before taking the batch.
+        """
+        self._count += 1
+        self._wait += wait
+        self._total += total
+        self._occupancy += occupancy
+        pass
+
+    def decide(self, num_threads, queue_size):
+        """Decide on the pool size, every interval batches.
+
+        Returns:
+            (num_threads, queue_size, stats) if the pool should change, None
+            otherwise.
+        """
+        if self._count < self.interval:
+            return None
+        stats = {
+            'wait_ratio': self._wait / max(self._total, 1e-6),
+            'wait_ms': self._wait / self._count * 1000,
+            'occupancy': self._occupancy / self._count
+        }
+        self.reset()
+        new_threads = num_threads
+        new_size = queue_size
+        if stats['wait_ratio'] > self.starve_ratio:
+            if num_threads < self.num_threads_range[1]:
+                new_threads += 1
+            elif queue_size < self.queue_size_range[1]:
+                new_size += 1
+        elif stats['wait_ratio'] < self.idle_ratio and \
+                stats['occupancy'] > self.full_ratio * queue_size:
+            if num_threads > self.num_threads_range[0]:
+                new_threads -= 1
+            elif queue_size > self.queue_size_range[0]:
+                new_size -= 1
+        if new_threads == num_threads and new_size == queue_size:
+            return None
+        return new_threads, new_size, stats
+    pass
+
+
 class ConcurrentBatchIterator(IBatchIterator):
 
-    def __init__(self, batch_iter, max_queue_size=10, num_threads=5):
+    def __init__(self, batch_iter, max_queue_size=10, num_threads=5,
+                 mode='thread', zero_copy=False, in_place=False,
+                 auto_tune=False, num_threads_range=None,
+                 queue_size_range=None):
         """
         Data provider wrapper that supports concurrent data fetching.
+
+        Args:
+            batch_iter: BatchIterator.
+            max_queue_size: int, maximum number of prefetched batches.
+            num_threads: int, number of producer threads (or processes).
+            mode: 'thread' or 'process'. In process mode, batches are built by
+            forked worker processes and returned through shared memory, so
+            that decoding does not contend for the GIL. The batch iterator
+            needs a get_fn, and the data provider must be safe to fork (i.e.
+            no TensorFlow session created before this constructor). The
+            workers are only forked here, and crashed workers are replaced by
+            threads. Workers reseed the data provider (see
+            BatchIterator.reseed). Providers that ignore the batch indices,
+            such as streams, are rejected, since every worker would replay
+            the same stream.
+            zero_copy: bool, whether to avoid copying batches. In thread mode,
+            batches are built in place into a ring of preallocated slots if
+            the batch iterator has a get_fn (i.e. zero_copy implies
+            in_place), and handed over as built otherwise. In process mode,
+            batches always cross through a shared ring, and zero_copy returns
+            views into the slots instead of copies. The consumer must call
+            release(batch) once done with a view.
+            in_place: bool, whether get_fn fills the ring slots directly,
+            passed as its `out` argument (see DataProvider.get_batch_idx),
+            instead of having its batches copied in. Needs a get_fn. In
+            thread mode, implied by zero_copy.
+
+            Copies per batch: thread mode, none (one allocation), or none and
+            no allocation with zero_copy. Process mode, two (into and out of
+            the ring), one with in_place or zero_copy, none with both.
+            auto_tune: bool, whether to resize the pool while iterating, see
+            ProducerPoolTuner. max_queue_size and num_threads are then the
+            initial sizes. In process mode, the queue size is fixed, and all
+            the workers of num_threads_range are forked upfront, the idle ones
+            parked.
+            num_threads_range: (min, max) number of producers, default
+            (1, 2 * num_threads).
+            queue_size_range: (min, max) queue size, default
+            (2, 2 * max_queue_size).
         """
         super(ConcurrentBatchIterator, self).__init__()
         self.max_queue_size = max_queue_size
         self.num_threads = num_threads
-        self.q = Queue.Queue(maxsize=max_queue_size)
         self.log = tfplus.utils.logger.get()
-        self.fetchers = []
-        for ii in xrange(num_threads):
-            f = BatchProducer(self.q, batch_iter)
-            f.start()
-            self.fetchers.append(f)
         self.batch_iter = batch_iter
+        self.mode = mode
+        has_get_fn = getattr(batch_iter, 'get_fn', None) is not None
+        if mode == 'thread' and zero_copy and has_get_fn:
+            # Saves both the allocation and the copy of each batch.
+            in_place = True
+        self.zero_copy = zero_copy
+        self.in_place = in_place
+        self.fetchers = []
+        self.ring = None
+        self._first_batch = None
+        # Resume point: batches consumed since the step of the batch iterator
+        # at construction, see get_state.
+        self._start_step = batch_iter.step
+        self._num_consumed = 0
+        self.tuner = None
+        if auto_tune:
+            if num_threads_range is None:
+                num_threads_range = (1, 2 * num_threads)
+            if queue_size_range is None:
+                if mode == 'process':
+                    queue_size_range = (max_queue_size, max_queue_size)
+                else:
+                    queue_size_range = (2, 2 * max_queue_size)
+            self.tuner = ProducerPoolTuner(num_threads_range,
+                                           queue_size_range)
+        self._last_time = None
+        if mode not in ['thread', 'process']:
+            raise Exception('Unknown mode: {}'.format(mode))
+        if mode == 'process' and not has_get_fn:
+            raise Exception('Process mode requires a get_fn')
+        provider = getattr(batch_iter, 'data_provider', None)
+        if mode == 'process' and not getattr(provider, 'indexed', True):
+            raise Exception('Process mode requires batches that follow their '
+                            'indices, got {}'.format(type(provider).__name__))
+        if in_place and (not has_get_fn or
+                         (mode == 'thread' and not zero_copy)):
+            raise Exception('In place mode requires a get_fn, and zero_copy '
+                            'in thread mode')
+        if mode == 'process' or in_place:
+            # Use the first batch to lay out the ring slots.
+            self._first_batch = batch_iter.next()
+            # Slots can be queued, being written, or held by the consumer.
+            if self.tuner is not None:
+                num_slots = self.tuner.queue_size_range[1] + \
+                    self.tuner.num_threads_range[1] + 2
+            else:
+                num_slots = max_queue_size + num_threads + 2
+            self.ring = BatchRing(self._first_batch, num_slots=num_slots,
+                                  shared=mode == 'process')
+            self.log.info('Batch ring slots: {} x {:.2f} MB'.format(
+                self.ring.num_slots, self.ring.slot_bytes / 1024 / 1024))
+        if mode == 'thread':
+            self.q = ResizableQueue(maxsize=max_queue_size)
+        else:
+            self.q = multiprocessing.Queue(maxsize=max_queue_size)
+            self.task_q = multiprocessing.Queue(maxsize=max_queue_size)
+            self.dispatcher = IndexProducer(
+                self.task_q, batch_iter, num_threads)
+            self.dispatcher.start()
+        self._num_spawned = 0
+        num_fetchers = num_threads
+        if mode == 'process' and self.tuner is not None:
+            # Never fork once training has started.
+            num_fetchers = max(num_threads, self.tuner.num_threads_range[1])
+        for ii in xrange(num_fetchers):
+            self.fetchers.append(self.new_fetcher())
+            if ii >= num_threads:
+                self.fetchers[-1].active.clear()
         self.counter = 0
         pass
 
+    def resize(self, num_threads, queue_size):
+        """Resize the producer pool and the queue.
+
+        Threads are started and stopped. Worker processes are only parked and
+        unparked, up to the pool forked upfront.
+        """
+        if self.mode == 'thread':
+            while self.num_threads < num_threads:
+                self.fetchers.append(self.new_fetcher())
+                self.num_threads += 1
+            while self.num_threads > num_threads:
+                # Finishes its current batch first.
+                self.fetchers.pop().stopped = True
+                self.num_threads -= 1
+        else:
+            active = [ff for ff in self.fetchers if ff.active.is_set()]
+            parked = [ff for ff in self.fetchers if not ff.active.is_set()]
+            num_threads = min(num_threads, len(self.fetchers))
+            while len(active) < num_threads:
+                ff = parked.pop(0)
+                ff.active.set()
+                active.append(ff)
+            while len(active) > num_threads:
+                # Finishes its current batch first.
+                active.pop().active.clear()
+            self.num_threads = num_threads
+        if self.mode == 'process':
+            self.dispatcher.num_workers = self.num_threads
+        if queue_size != self.max_queue_size and self.mode == 'thread':
+            self.q.resize(queue_size)
+            self.max_queue_size = queue_size
+        pass
+
+    def tune(self, wait, occupancy):
+        now = time.time()
+        if self._last_time is not None:
+            self.tuner.record(wait, now - self._last_time, occupancy)
+        self._last_time = now
+        decision = self.tuner.decide(self.num_threads, self.max_queue_size)
+        if decision is not None:
+            num_threads, queue_size, stats = decision
+            self.log.info(
+                'Producer pool: wait {:.1f}% ({:.2f} ms/batch), queue '
+                'occupancy {:.1f}/{:d}. Threads {:d} => {:d}, queue size '
+                '{:d} => {:d}'.format(
+                    stats['wait_ratio'] * 100, stats['wait_ms'],
+                    stats['occupancy'], self.max_queue_size,
+                    self.num_threads, num_threads, self.max_queue_size,
+                    queue_size))
+            self.resize(num_threads, queue_size)
+        pass
+
+    def new_fetcher(self, thread=False):
+        """Start a producer.
+
+        Args:
+            thread: bool, in process mode, whether to start a worker thread
+            instead of forking a worker process.
+        """
+        if self.mode == 'thread':
+            f = BatchProducer(self.q, self.batch_iter, ring=self.ring,
+                              in_place=self.in_place, index=self._num_spawned)
+        elif thread:
+            f = WorkerThread(self.task_q, self.q, self.batch_iter, self.ring,
+                             in_place=self.in_place, index=self._num_spawned)
+        else:
+            f = BatchWorker(self.task_q, self.q, self.batch_iter, self.ring,
+                            in_place=self.in_place, index=self._num_spawned)
+        self._num_spawned += 1
+        f.start()
+        return f
+
+    def is_crashed(self, ff):
+        """Whether a producer died, rather than exited after the end of the
+        iteration or being stopped."""
+        if isinstance(ff, BatchWorker):
+            return ff.crashed
+        return not ff.is_alive() and not ff.finished
+
     def scan(self):
         dead = []
         num_alive = 0
         for ff in self.fetchers:
-            if not ff.is_alive():
-                dead.append(ff)
-                self.log.info('Found one dead thread. Relaunching.')
-                fnew = BatchProducer(self.q, self.batch_iter)
-                fnew.start()
-                self.fetchers.append(fnew)
-            else:
+            if ff.is_alive():
                 num_alive += 1
+                continue
+            dead.append(ff)
+            if not self.is_crashed(ff):
+                continue
+            if isinstance(ff, BatchWorker):
+                # Forking now would copy the TensorFlow threads.
+                self.log.warning('Found one dead process. Replacing it with '
+                                 'a thread.')
+            else:
+                self.log.warning('Found one dead thread. Relaunching.')
+            if self.ring is not None:
+                num_slots = self.ring.reclaim(ff.token)
+                if num_slots > 0:
+                    self.log.warning(
+                        'Reclaimed {} batch slots'.format(num_slots))
+            f = self.new_fetcher(thread=True)
+            if self.mode == 'process' and not ff.active.is_set():
+                f.active.clear()
+            self.fetchers.append(f)
         self.log.info('Number of alive threads: {}'.format(num_alive))
         for dd in dead:
             self.fetchers.remove(dd)
         pass
 
     def next(self):
+        if self._first_batch is not None:
+            batch = self._first_batch
+            self._first_batch = None
+            self._num_consumed += 1
+            return batch
+        if self.tuner is not None:
+            occupancy = self.q.qsize()
         if self.counter % 10 == 0:
             s = self.q.qsize()
             if s > self.max_queue_size / 3:
@@ -71,10 +536,54 @@ class ConcurrentBatchIterator(IBatchIterator):
                 self.log.warning('Data queue size: {}'.format(s))
             self.scan()
             self.counter = 0
+        start_time = time.time()
         batch = self.q.get()
+        wait_time = time.time() - start_time
+        profiler.get().record('queue_get', wait_time)
+        if self.tuner is not None:
+            self.tune(wait_time, occupancy)
         if batch is None:
             raise StopIteration
-        self.q.task_done()
+        if self.mode == 'thread':
+            self.q.task_done()
+        if self.ring is not None:
+            batch = self.ring.read(batch, copy=not self.zero_copy)
         self.counter += 1
+        self._num_consumed += 1
         return batch
+
+    def release(self, batch):
+        if isinstance(batch, RingBatch):
+            self.ring.release(batch)
+        pass
+
+    def finalize(self):
+        self.batch_iter.finalize()
+        pass
+
+    def get_state(self):
+        """Get the iteration state of the underlying batch iterator, at the
+        number of batches consumed.
+
+        Batches still waiting in the queue are produced again on resume. With
+        several producers, batches may be consumed out of order, so that the
+        last few batches before the resume point can be skipped or repeated.
+        """
+        return self.batch_iter.get_state(
+            step=self._start_step + self._num_consumed)
+
+    def set_state(self, state):
+        """Resume from a state returned by get_state. Call it before
+        iterating, since prefetched batches are not discarded."""
+        self.batch_iter.set_state(state)
+        self._start_step = self.batch_iter.step
+        self._num_consumed = 0
+        return self
+
+    def save_state(self, folder, name):
+        OptionSaver(folder, name).save(self.get_state())
+        pass
+
+    def restore_state(self, folder, name):
+        return self.set_state(OptionSaver(folder, name).read())
     pass
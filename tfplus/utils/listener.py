@@ -1,4 +1,8 @@
+import collections
+import threading
+
 from tfplus.utils import Factory
+import logger
 
 _factory = None
 
@@ -15,6 +19,18 @@ def register(name, cls):
     return get_factory().register(name, cls)
 
 
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ListenerExecutor()
+        _executor.start()
+        pass
+    return _executor
+
+
 def create(_clsname, **kwargs):
     return get_factory().create(_clsname, **kwargs)
 
@@ -46,3 +62,189 @@ class AdapterListener(Listener):
         return self._listener.listen(results2)
 
 get_factory().register('adapter', AdapterListener)
+
+
+class Countdown(object):
+    """Calls a function once counted down to zero."""
+
+    def __init__(self, count, fn):
+        self._count = count
+        self._fn = fn
+        self._lock = threading.Lock()
+        pass
+
+    def tick(self):
+        self._lock.acquire()
+        try:
+            self._count -= 1
+            fire = self._count == 0
+        finally:
+            self._lock.release()
+        if fire:
+            self._fn()
+        pass
+    pass
+
+
+def dispatch(listeners, results, done=None):
+    """Hand results to listeners.
+
+    Args:
+        listeners: list of Listener.
+        results: dict, not to be modified afterwards, since asynchronous
+        listeners keep it as is.
+        done: function called once no listener uses the results anymore.
+    """
+    async_listeners = [ll for ll in listeners if isinstance(ll, AsyncListener)]
+    if done is not None and len(async_listeners) > 0:
+        countdown = Countdown(len(async_listeners), done)
+        done_async = countdown.tick
+    else:
+        done_async = None
+    for ll in listeners:
+        if isinstance(ll, AsyncListener):
+            ll.submit(results, done=done_async)
+        else:
+            ll.listen(results)
+    if done is not None and len(async_listeners) == 0:
+        done()
+    pass
+
+
+class ListenerExecutor(threading.Thread):
+    """Runs the asynchronous listeners in turn, on one background thread, so
+    that plotting stays on a single thread."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cond = threading.Condition()
+        self.listeners = []
+        self._next = 0
+        self.log = logger.get()
+        pass
+
+    def add(self, listener):
+        self.cond.acquire()
+        try:
+            self.listeners.append(listener)
+        finally:
+            self.cond.release()
+        pass
+
+    def take(self):
+        """Take the next pending item, round robin across listeners. Call with
+        the condition held."""
+        num = len(self.listeners)
+        for ii in xrange(num):
+            listener = self.listeners[(self._next + ii) % num]
+            if len(listener.pending) > 0:
+                self._next = (self._next + ii + 1) % num
+                return listener, listener.pending.popleft()
+        return None, None
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                listener, item = self.take()
+                while listener is None:
+                    self.cond.wait()
+                    listener, item = self.take()
+                listener.num_running += 1
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+            results, done = item
+            try:
+                listener.listener.listen(results)
+            except Exception as e:
+                self.log.error('Listener failed: {}'.format(e))
+            finally:
+                if done is not None:
+                    done()
+                self.cond.acquire()
+                listener.num_running -= 1
+                self.cond.notify_all()
+                self.cond.release()
+        pass
+    pass
+
+
+class AsyncListener(Listener):
+    """Runs a listener on the background executor, through a bounded queue.
+
+    Results are handed over as is, without copies.
+    """
+
+    def __init__(self, listener=None, policy='drop_oldest', queue_size=4,
+                 executor=None):
+        """
+        Args:
+            listener: Listener to run.
+            policy: what to do when the queue is full, 'drop_oldest' to drop
+            the oldest pending results, 'coalesce' to only keep the latest
+            results (any queue size), or 'block' to wait for room.
+            queue_size: int, number of pending results.
+            executor: ListenerExecutor, default the shared one.
+        """
+        if policy not in ['drop_oldest', 'coalesce', 'block']:
+            raise Exception('Unknown listener policy {}'.format(policy))
+        self.listener = listener
+        self.policy = policy
+        self.queue_size = queue_size
+        self.pending = collections.deque()
+        self.num_running = 0
+        self.num_dropped = 0
+        if executor is None:
+            executor = get_executor()
+        self.executor = executor
+        executor.add(self)
+        pass
+
+    def submit(self, results, done=None):
+        """Queue results.
+
+        Args:
+            results: dict.
+            done: function called once the listener is done with the results,
+            or has dropped them.
+        """
+        dropped = []
+        cond = self.executor.cond
+        cond.acquire()
+        try:
+            if self.policy == 'coalesce':
+                while len(self.pending) > 0:
+                    dropped.append(self.pending.popleft())
+            elif self.policy == 'drop_oldest':
+                while len(self.pending) >= self.queue_size:
+                    dropped.append(self.pending.popleft())
+            else:
+                while len(self.pending) >= self.queue_size:
+                    cond.wait()
+            self.pending.append((results, done))
+            self.num_dropped += len(dropped)
+            cond.notify_all()
+        finally:
+            cond.release()
+        for item_results, item_done in dropped:
+            if item_done is not None:
+                item_done()
+        pass
+
+    def listen(self, results):
+        self.submit(results)
+        pass
+
+    def flush(self):
+        """Wait until all pending results have been processed."""
+        cond = self.executor.cond
+        cond.acquire()
+        try:
+            while len(self.pending) > 0 or self.num_running > 0:
+                cond.wait()
+        finally:
+            cond.release()
+        pass
+    pass
@@ -0,0 +1,202 @@
+"""
+A deterministic, resumable and sharded sampler.
+
+Each epoch is a permutation seeded by (seed, epoch), so that any position in
+the stream of examples can be recomputed without replaying the previous ones.
+With world_size > 1, each rank takes a disjoint slice of every epoch.
+
+Usage:
+    sampler = ShardedSampler(1000, seed=2, rank=0, world_size=4)
+    idx = sampler.get_indices(start=0, end=25)
+    state = sampler.get_state()
+    ...
+    sampler.set_state(state)
+"""
+from __future__ import division
+
+import numpy as np
+
+
+class ShardedSampler(object):
+
+    def __init__(self, num, seed=2, shuffle=True, rank=0, world_size=1):
+        """
+        Args:
+            num: int, number of examples in the dataset.
+            seed: int, base random seed.
+            shuffle: bool, whether to permute the examples every epoch.
+            rank: int, index of this shard.
+            world_size: int, number of shards.
+        """
+        if rank < 0 or rank >= world_size:
+            raise Exception('Invalid rank {} for world size {}'.format(
+                rank, world_size))
+        self._num = num
+        self._seed = seed
+        self._shuffle = shuffle
+        self._rank = rank
+        self._world_size = world_size
+        # All shards take the same number of examples, so that they stay in
+        # step. Up to world_size - 1 examples are left out of every epoch.
+        if world_size > 1:
+            self._shard_size = num // world_size
+        else:
+            self._shard_size = num
+        # (epoch, indices) of the last two epochs requested, so that batches
+        # wrapping around an epoch boundary hit the cache.
+        self._cache = ((None, None), (None, None))
+        pass
+
+    @property
+    def num(self):
+        return self._num
+
+    @property
+    def seed(self):
+        return self._seed
+
+    @property
+    def shuffle(self):
+        return self._shuffle
+
+    @property
+    def rank(self):
+        return self._rank
+
+    @property
+    def world_size(self):
+        return self._world_size
+
+    @property
+    def shard_size(self):
+        """Number of examples per epoch in this shard."""
+        return self._shard_size
+
+    def get_epoch_indices(self, epoch):
+        """Get the example indices of this shard for an epoch."""
+        # Read the cache in one go, as other threads may replace it.
+        cache = self._cache
+        for cached_epoch, cached_idx in cache:
+            if cached_epoch == epoch:
+                return cached_idx
+        idx = self.build_epoch_indices(epoch)
+        self._cache = ((epoch, idx), cache[0])
+        return idx
+
+    def build_epoch_indices(self, epoch):
+        if self._shuffle:
+            random = np.random.RandomState([self._seed, epoch])
+            idx = random.permutation(self._num)
+        else:
+            idx = np.arange(self._num)
+        if self._world_size > 1:
+            idx = idx[self._rank: self._shard_size * self._world_size:
+                      self._world_size]
+        return idx
+
+    def get_indices(self, start, end):
+        """Get the example indices for a range of positions.
+
+        Positions count examples of this shard from the very first epoch, and
+        may span several epochs.
+        """
+        idx = []
+        while start < end:
+            epoch = start // self._shard_size
+            offset = start - epoch * self._shard_size
+            count = min(end - start, self._shard_size - offset)
+            idx.append(self.get_epoch_indices(epoch)[offset: offset + count])
+            start += count
+        if len(idx) == 1:
+            return idx[0]
+        elif len(idx) == 0:
+            return np.zeros([0], dtype='int64')
+        return np.concatenate(idx)
+
+    def get_state(self):
+        return {
+            'num': self._num,
+            'seed': self._seed,
+            'shuffle': self._shuffle,
+            'rank': self._rank,
+            'world_size': self._world_size
+        }
+
+    def set_state(self, state):
+        """Resume from a state of a sampler over the same examples.
+
+        States saved before num and shuffle were recorded are not checked
+        against them.
+        """
+        for key in ['num', 'shuffle', 'world_size']:
+            if key in state and state[key] != getattr(self, '_' + key):
+                raise Exception('Cannot resume {} {} from {} {}'.format(
+                    key, getattr(self, '_' + key), key, state[key]))
+        self._seed = state['seed']
+        self._rank = state['rank']
+        self._cache = ((None, None), (None, None))
+        return self
+    pass
+
+
+class BucketSampler(ShardedSampler):
+
+    def __init__(self, buckets, batch_size, seed=2, shuffle=True, rank=0,
+                 world_size=1, drop_last=True):
+        """
+        Every batch_size consecutive positions, starting from 0, hold
+        examples of a single bucket. With shuffle, examples are permuted
+        within buckets, then whole batches are permuted.
+
+        Args:
+            buckets: [N] int, bucket of every example.
+            batch_size: int.
+            seed: int, base random seed.
+            shuffle: bool, whether to permute the batches every epoch.
+            rank: int, index of this shard.
+            world_size: int, number of shards, which take whole batches.
+            drop_last: bool, whether to drop the examples left over by each
+            bucket. Otherwise, the last batch of a bucket is filled up with
+            repeated examples of the bucket.
+        """
+        buckets = np.asarray(buckets)
+        super(BucketSampler, self).__init__(
+            buckets.shape[0], seed=seed, shuffle=shuffle, rank=rank,
+            world_size=world_size)
+        self._batch_size = batch_size
+        self._drop_last = drop_last
+        self._groups = [np.nonzero(buckets == bb)[0]
+                        for bb in np.unique(buckets)]
+        num_batches = 0
+        for group in self._groups:
+            if drop_last:
+                num_batches += group.shape[0] // batch_size
+            else:
+                num_batches += int(np.ceil(group.shape[0] / batch_size))
+        self._num_batches = num_batches // world_size
+        if self._num_batches == 0:
+            raise Exception('No full batch of size {}'.format(batch_size))
+        self._shard_size = self._num_batches * batch_size
+        pass
+
+    def build_epoch_indices(self, epoch):
+        random = np.random.RandomState([self._seed, epoch])
+        batches = []
+        for group in self._groups:
+            if self._shuffle:
+                group = random.permutation(group)
+            num_full = group.shape[0] // self._batch_size * self._batch_size
+            batches.append(group[:num_full].reshape([-1, self._batch_size]))
+            num_left = group.shape[0] - num_full
+            if num_left > 0 and not self._drop_last:
+                fill = np.resize(group, [self._batch_size - num_left])
+                batches.append(np.concatenate(
+                    [group[num_full:], fill]).reshape([1, -1]))
+        batches = np.concatenate(batches)
+        if self._shuffle:
+            batches = batches[random.permutation(batches.shape[0])]
+        batches = batches[self._rank:
+                          self._num_batches * self._world_size:
+                          self._world_size]
+        return batches.reshape([-1])
+    pass